@@ -0,0 +1,111 @@
+# Async module for database communication
+# The FastAPI handlers are coroutines, so the blocking pymongo calls in db.py are run on a
+# bounded thread pool instead of on the event loop. One slow query no longer stalls the worker.
+
+import asyncio
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pymongo.errors import AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError
+import db
+from project_utils import Logger, ErrorHandler  # Import the Logger and ErrorHandler
+
+logger = Logger(__name__)
+
+# Executor and retry settings. The executor should not be larger than the Mongo pool,
+# otherwise threads just wait on a connection checkout
+EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(db.POOL_SETTINGS["maxPoolSize"])))
+RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("DB_RETRY_BACKOFF_SECONDS", "0.1"))
+QUERY_TIMEOUT_SECONDS = float(os.getenv("DB_QUERY_TIMEOUT_SECONDS", "30"))
+
+# Errors worth retrying: the driver lost or could not reach the server
+RETRYABLE_ERRORS = (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError)
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="mongo")
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking db function on the executor, with timeout and retries on transient errors."""
+    loop = asyncio.get_running_loop()
+    call = partial(func, *args, **kwargs)
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(executor, call), QUERY_TIMEOUT_SECONDS)
+        except RETRYABLE_ERRORS as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise ErrorHandler.DatabaseConnectionError(f"Database unavailable after {attempt} attempts: {str(e)}")
+            logger.log(f"Transient database error on attempt {attempt}: {str(e)}", logging.WARNING)
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        except asyncio.TimeoutError:
+            raise ErrorHandler.DatabaseConnectionError(f"Database call {func.__name__} timed out after {QUERY_TIMEOUT_SECONDS}s")
+
+
+async def get_mongo_collection(collection_name: str, query: dict = None, projection: dict = None,
+                               sort: list = None, limit: int = 0, skip: int = 0):
+    return await run(db.get_mongo_collection, collection_name, query, projection, sort, limit, skip)
+
+
+async def iterate_batches(collection_name: str, query: dict = None, projection: dict = None,
+                          sort: list = None, limit: int = 0, batch_size: int = db.BATCH_SIZE):
+    """Async generator over db.find_batches. Each batch is pulled from the cursor on the executor."""
+    loop = asyncio.get_running_loop()
+    batches = db.find_batches(collection_name, query, projection, sort, limit, batch_size)
+    try:
+        while True:
+            batch = await loop.run_in_executor(executor, next, batches, None)
+            if batch is None:
+                return
+            yield batch
+    finally:
+        # Closes the server cursor when the consumer stops early, e.g. a client disconnecting mid-stream
+        await loop.run_in_executor(executor, batches.close)
+
+
+async def count(collection_name: str, query: dict = None, limit: int = 0):
+    return await run(db.count, collection_name, query, limit)
+
+
+async def exists(collection_name: str, query: dict = None):
+    return await run(db.exists, collection_name, query)
+
+
+async def get_presence_flags(exam_name: str):
+    return await run(db.get_presence_flags, exam_name)
+
+
+async def get_distinct_values(collection_name: str, field: str, query: dict = None):
+    return await run(db.get_distinct_values, collection_name, field, query)
+
+
+async def aggregate_mongo_collection(collection_name: str, pipeline: list):
+    return await run(db.aggregate_mongo_collection, collection_name, pipeline)
+
+
+async def update_mongo_collection(collection_name: str, query: dict, update: dict, upsert: bool = False, many: bool = False):
+    return await run(db.update_mongo_collection, collection_name, query, update, upsert, many)
+
+
+async def insert_into_mongo_collection(collection_name: str, data: dict):
+    return await run(db.insert_into_mongo_collection, collection_name, data)
+
+
+async def insert_many_into_mongo_collection(collection_name: str, documents: list):
+    return await run(db.insert_many_into_mongo_collection, collection_name, documents)
+
+
+async def delete_from_mongo_collection(collection_name: str, query: dict):
+    return await run(db.delete_from_mongo_collection, collection_name, query)
+
+
+async def clear_mongo_collection(collection_name: str):
+    return await run(db.clear_mongo_collection, collection_name)
+
+
+async def replace_collection(collection_name: str, staging_name: str):
+    return await run(db.replace_collection, collection_name, staging_name)
+
+
+async def ensure_indexes():
+    return await run(db.ensure_indexes)
@@ -0,0 +1,8 @@
+# Benchmarks for the proctoring back-end. Run them from the repository root, e.g.
+# python -m benchmarks.bench_async_db
+
+import os
+
+# Benchmarks must never touch the production cluster configured in .env. db.py connects at
+# import time, so point it at localhost before anything imports it (load_dotenv won't override)
+os.environ["MONGODB_URI"] = "mongodb://localhost:27017"
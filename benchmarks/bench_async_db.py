@@ -0,0 +1,85 @@
+# Concurrency benchmark for the data-access layer
+# Compares calling the blocking db.py functions directly inside coroutines (what the handlers
+# used to do) against the executor-backed async_db module, under parallel load.
+#
+# python -m benchmarks.bench_async_db [--uri mongodb://localhost:27017] [--rate 100]
+
+import argparse
+import asyncio
+import json
+import time
+import db
+import async_db
+from benchmarks.common import use_database, summarize, Timer
+
+
+def seed(database, students: int, events: int):
+    database["blur"].delete_many({})
+    database["blur"].insert_many([
+        {"exam": "bench", "student": f"student{s}@fi.uba.ar", "time": f"2023-09-01T10:{e % 60:02d}:00", "msg": "blur"}
+        for s in range(students) for e in range(events)
+    ])
+
+
+def add_latency(latency_ms: float):
+    """Simulate the network round trip mongomock does not have, so blocking calls are visible."""
+    original = db.get_mongo_collection
+
+    def slow_get_mongo_collection(*args, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return original(*args, **kwargs)
+
+    db.get_mongo_collection = slow_get_mongo_collection
+
+
+async def run_mode(mode: str, requests: int, rate: float, students: int):
+    """Open-loop load: request i arrives at i / rate seconds, latency is measured from its arrival.
+    Measuring from arrival (not from when the coroutine got to run) counts the time a request
+    spends waiting behind a blocked event loop."""
+    async def blocking_fetch(collection, query):
+        return db.get_mongo_collection(collection, query)
+
+    fetch = blocking_fetch if mode == "blocking" else async_db.get_mongo_collection
+    latencies = []
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def one_request(i):
+        arrival = start + i / rate
+        await asyncio.sleep(max(0, arrival - loop.time()))
+        await fetch("blur", {"exam": "bench", "student": f"student{i % students}@fi.uba.ar"})
+        latencies.append(loop.time() - arrival)
+
+    with Timer() as timer:
+        await asyncio.gather(*(one_request(i) for i in range(requests)))
+    return summarize(latencies, timer.elapsed)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--uri", help="Local mongod URI. Uses mongomock when omitted")
+    arg_parser.add_argument("--requests", type=int, default=500)
+    arg_parser.add_argument("--rate", type=float, default=100, help="Arrival rate in requests per second")
+    arg_parser.add_argument("--students", type=int, default=50)
+    arg_parser.add_argument("--events", type=int, default=20)
+    arg_parser.add_argument("--latency-ms", type=float, default=None,
+                            help="Simulated query latency. Defaults to 5ms on mongomock, 0 on mongod")
+    args = arg_parser.parse_args()
+
+    database = use_database(args.uri)
+    seed(database, args.students, args.events)
+    latency_ms = args.latency_ms if args.latency_ms is not None else (0 if args.uri else 5)
+    if latency_ms:
+        add_latency(latency_ms)
+
+    results = {
+        mode: asyncio.run(run_mode(mode, args.requests, args.rate, args.students))
+        for mode in ("blocking", "executor")
+    }
+    results["settings"] = {"rate": args.rate, "latency_ms": latency_ms,
+                           "executor_workers": async_db.EXECUTOR_WORKERS}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Microbenchmark for the BSON -> JSON-safe conversion in db.get_mongo_collection
+# Compares the old json_util.dumps + json.loads round-trip with db.to_json_safe on synthetic
+# periodicPhotos documents holding large base64 images. Reports latency and peak memory.
+#
+# python -m benchmarks.bench_bson_conversion [--documents 50] [--image-kb 300]
+
+import argparse
+import json
+import tracemalloc
+from datetime import datetime, timedelta
+from bson import json_util, ObjectId
+import db
+from benchmarks.common import synthetic_image_data_url, Timer
+
+
+def round_trip(documents: list):
+    return json.loads(json_util.dumps(documents))
+
+
+def direct(documents: list):
+    return [db.to_json_safe(document) for document in documents]
+
+
+def measure(convert, documents: list, repeat: int):
+    with Timer() as timer:
+        for _ in range(repeat):
+            convert(documents)
+    tracemalloc.start()
+    convert(documents)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mean_ms": round(timer.elapsed / repeat * 1000, 2), "peak_mb": round(peak / 2**20, 2)}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--documents", type=int, default=50)
+    arg_parser.add_argument("--image-kb", type=int, default=300)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    start = datetime(2023, 9, 1, 10, 0)
+    documents = [
+        {"_id": ObjectId(), "exam": "bench", "student": "student@fi.uba.ar",
+         "time": (start + timedelta(seconds=30 * i)).isoformat(), "createdAt": start + timedelta(seconds=30 * i),
+         "image": synthetic_image_data_url(args.image_kb)}
+        for i in range(args.documents)
+    ]
+    assert round_trip(documents) == direct(documents), "conversion paths disagree"
+
+    results = {
+        "json_util_round_trip": measure(round_trip, documents, args.repeat),
+        "to_json_safe": measure(direct, documents, args.repeat),
+        "settings": {"documents": args.documents, "image_kb": args.image_kb},
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# CPU throughput benchmark for the batched object detection in ml_utils
+# Uses a tiny randomly initialised YOLOS, so it measures the pipeline (decode, batching,
+# pre/post-processing, inference mode) rather than the accuracy of the real checkpoint.
+#
+# Each batch size is run with full-resolution decoding and with draft decoding to the model input size.
+#
+# python -m benchmarks.bench_object_detection [--images 64] [--batch-sizes 1,4,8,16]
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import image_utils
+import ml_utils as ML
+from benchmarks.common import synthetic_jpeg_data_url, tiny_yolos, Timer
+
+
+def images_per_second(base64_images: list, batch_size: int, image_processor, model, draft_size: int = None):
+    batches = [base64_images[start:start + batch_size] for start in range(0, len(base64_images), batch_size)]
+    with ThreadPoolExecutor(max_workers=ML.OD_DECODE_WORKERS) as pool, Timer() as timer:
+        for _, images in image_utils.decode_ahead(batches, lambda batch: batch, pool, draft_size):
+            ML.detect_objects(images, image_processor, model)
+    return round(len(base64_images) / timer.elapsed, 2)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--images", type=int, default=64)
+    arg_parser.add_argument("--batch-sizes", default="1,4,8,16")
+    arg_parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    args = arg_parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    image_processor, model = tiny_yolos()
+    # Webcam-sized frames, larger than the model input so draft decoding has something to skip
+    base64_images = [synthetic_jpeg_data_url(1280, 720, seed=i) for i in range(args.images)]
+    draft_size = image_utils.model_input_size(image_processor)
+    # Warm-up run so lazy initialisation does not count against the first batch size
+    images_per_second(base64_images[:2], 2, image_processor, model)
+
+    results = {}
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        results[f"batch_{batch_size}"] = images_per_second(base64_images, batch_size, image_processor, model)
+        results[f"batch_{batch_size}_draft"] = images_per_second(base64_images, batch_size, image_processor, model, draft_size)
+    results["settings"] = {"images": args.images, "decode_workers": ML.OD_DECODE_WORKERS,
+                           "torch_threads": torch.get_num_threads(), "unit": "images/sec"}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# Accuracy parity and CPU throughput of the "quantized" inference backend against the float models
+# For the object detector and the zero-shot speech classifier it reports:
+# - parity: the largest difference between float and quantized class probabilities / theme scores,
+#   and how often both pick the same top label
+# - throughput: images/sec and snippets/sec of each backend
+# By default tiny randomly initialised models are used, which only makes the throughput numbers meaningful.
+# With --pretrained the real checkpoints of ml_utils are loaded, and the script exits with status 1 when
+# parity is outside --tolerance / --min-agreement, so it can gate switching OD_BACKEND / SPEECH_BACKEND.
+# When the checkpoints cannot be downloaded nor found in the local cache, the check is skipped (status 0).
+# Without --pretrained, parity outside the tolerance only prints a warning.
+#
+# python -m benchmarks.bench_quantized_backend [--images 32] [--texts 64] [--pretrained]
+
+import argparse
+import copy
+import json
+import sys
+import torch
+import image_utils
+import ml_utils as ML
+from benchmarks.common import (synthetic_jpeg_data_url, synthetic_sentences, tiny_yolos,
+                               tiny_zero_shot_classifier, Timer)
+
+THEMES = ("math", "history", "phone call")
+
+
+def detector_outputs(images: list, image_processor, model):
+    # Class probabilities of every detection token, and how long the batches took
+    probabilities = []
+    with Timer() as timer, torch.inference_mode():
+        for start in range(0, len(images), ML.OD_BATCH_SIZE):
+            inputs = image_processor(images=images[start:start + ML.OD_BATCH_SIZE], return_tensors="pt")
+            probabilities.append(model(**inputs).logits.softmax(dim=-1))
+    return torch.cat(probabilities), len(images) / timer.elapsed
+
+
+def classifier_outputs(texts: list, classifier):
+    # Theme scores of every text, in THEMES order, and how long the batches took
+    theme_classifier = ML.ThemeClassifier(classifier, THEMES)
+    scores = []
+    with Timer() as timer:
+        for start in range(0, len(texts), ML.SPEECH_BATCH_SIZE):
+            for result in theme_classifier.classify(texts[start:start + ML.SPEECH_BATCH_SIZE]):
+                by_label = dict(zip(result["labels"], result["scores"]))
+                scores.append([by_label[theme] for theme in THEMES])
+    return torch.tensor(scores), len(texts) / timer.elapsed
+
+
+def compare(float_model, quantized_model, float_outputs, quantized_outputs, float_rate: float, quantized_rate: float):
+    return {
+        "max_abs_difference": round((float_outputs - quantized_outputs).abs().max().item(), 4),
+        "top_label_agreement": round((float_outputs.argmax(-1) == quantized_outputs.argmax(-1)).float().mean().item(), 4),
+        "float_per_second": round(float_rate, 2),
+        "quantized_per_second": round(quantized_rate, 2),
+        "speedup": round(quantized_rate / float_rate, 2),
+        "float_mb": round(ML.resident_size(float_model) / 2**20, 1),
+        "quantized_mb": round(ML.resident_size(quantized_model) / 2**20, 1),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--images", type=int, default=32)
+    arg_parser.add_argument("--texts", type=int, default=64)
+    arg_parser.add_argument("--pretrained", action="store_true", help="use the real checkpoints (downloads them)")
+    arg_parser.add_argument("--tolerance", type=float, default=0.05, help="largest accepted probability difference")
+    arg_parser.add_argument("--min-agreement", type=float, default=0.95, help="smallest accepted top label agreement")
+    arg_parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    args = arg_parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # Both backends are built from the float models, whatever OD_BACKEND / SPEECH_BACKEND say
+    ML.MODEL_BACKENDS.update(object_detection_model="torch", speech_classifier="torch")
+
+    if args.pretrained:
+        try:
+            image_processor, detector, classifier = ML._load_image_processor(), ML._load_object_detection_model(), ML._load_speech_classifier()
+        except OSError as e:
+            # Offline, with no local copy of the checkpoints
+            print(f"Skipping the parity check, the pretrained checkpoints are unavailable: {str(e)}", file=sys.stderr)
+            return
+    else:
+        (image_processor, detector), classifier = tiny_yolos(), tiny_zero_shot_classifier()
+    quantized_detector = ML.with_backend("object_detection_model", copy.deepcopy(detector), "quantized")
+    quantized_classifier = ML.with_backend("speech_classifier", copy.deepcopy(classifier), "quantized")
+
+    draft_size = image_utils.model_input_size(image_processor)
+    images = [image_utils.decode_data_url(synthetic_jpeg_data_url(1280, 720, seed=i), draft_size)
+              for i in range(args.images)]
+    texts = synthetic_sentences(args.texts)
+    # Warm-up runs so lazy initialisation does not count against the float models
+    detector_outputs(images[:2], image_processor, detector)
+    detector_outputs(images[:2], image_processor, quantized_detector)
+    classifier_outputs(texts[:2], classifier)
+    classifier_outputs(texts[:2], quantized_classifier)
+
+    results = {}
+    float_probabilities, float_rate = detector_outputs(images, image_processor, detector)
+    quantized_probabilities, quantized_rate = detector_outputs(images, image_processor, quantized_detector)
+    results["object_detection"] = compare(detector, quantized_detector, float_probabilities, quantized_probabilities,
+                                          float_rate, quantized_rate)
+
+    float_scores, float_rate = classifier_outputs(texts, classifier)
+    quantized_scores, quantized_rate = classifier_outputs(texts, quantized_classifier)
+    results["speech_classifier"] = compare(classifier, quantized_classifier, float_scores, quantized_scores,
+                                           float_rate, quantized_rate)
+
+    results["settings"] = {"images": args.images, "texts": args.texts, "pretrained": args.pretrained,
+                           "torch_threads": torch.get_num_threads(), "tolerance": args.tolerance,
+                           "min_agreement": args.min_agreement}
+    print(json.dumps(results, indent=2))
+
+    parity = all(results[name]["max_abs_difference"] <= args.tolerance and
+                 results[name]["top_label_agreement"] >= args.min_agreement
+                 for name in ("object_detection", "speech_classifier"))
+    if not parity and args.pretrained:
+        print("Quantized backend is outside the parity tolerance", file=sys.stderr)
+        sys.exit(1)
+    if not parity:
+        print("Warning: quantized backend is outside the parity tolerance on the tiny random models. "
+              "Run with --pretrained to check the real checkpoints", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Shared helpers for the benchmark scripts
+
+import math
+import os
+import time
+import db
+
+
+def use_database(uri: str = None):
+    """Point db.py at a local mongod when a URI is given, otherwise at an in-memory mongomock."""
+    if uri:
+        from pymongo import MongoClient
+        db.client = MongoClient(uri, **db.POOL_SETTINGS)
+    else:
+        import mongomock
+        db.client = mongomock.MongoClient()
+    db.db = db.client["proctoring_benchmark"]
+    return db.db
+
+
+def percentile(values: list, p: float):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: list, elapsed: float):
+    """Latency percentiles in milliseconds plus throughput for a benchmark run."""
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+class Timer:
+    """Context manager measuring wall time with perf_counter."""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def synthetic_image_data_url(size_kb: int):
+    """A base64 data URL of roughly size_kb kilobytes, shaped like the images the front-end stores."""
+    import base64
+    import os
+    payload = base64.b64encode(os.urandom(size_kb * 768)).decode()
+    return f"data:image/jpeg;base64,{payload}"
+
+
+def synthetic_jpeg_data_url(width: int = 640, height: int = 480, seed: int = 0):
+    """A real JPEG webcam-sized frame (random noise over a gradient) as a base64 data URL."""
+    import base64
+    from io import BytesIO
+    import numpy
+    from PIL import Image
+    rng = numpy.random.default_rng(seed)
+    gradient = numpy.linspace(0, 255, width, dtype=numpy.uint8)[None, :, None].repeat(height, 0).repeat(3, 2)
+    noise = rng.integers(0, 64, size=(height, width, 3), dtype=numpy.uint8)
+    buffer = BytesIO()
+    Image.fromarray(gradient // 2 + noise).save(buffer, format="JPEG", quality=80)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def tiny_yolos():
+    """A randomly initialised YOLOS small enough for CPU benchmarks, with its image processor.
+    Built from a config, so nothing is downloaded."""
+    from transformers import YolosConfig, YolosForObjectDetection, YolosImageProcessor
+    config = YolosConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=2, intermediate_size=128,
+                         image_size=[256, 320], num_detection_tokens=10,
+                         id2label={0: "person", 1: "cell phone"}, label2id={"person": 0, "cell phone": 1})
+    model = YolosForObjectDetection(config).eval()
+    image_processor = YolosImageProcessor(size={"shortest_edge": 256, "longest_edge": 320})
+    return image_processor, model
+
+
+def tiny_zero_shot_classifier():
+    """A randomly initialised BERT NLI model wrapped in a zero-shot-classification pipeline, for CPU benchmarks.
+    The tokenizer vocabulary is written to a temporary directory, so nothing is downloaded."""
+    import tempfile
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast, pipeline
+    words = ("this example is a an the exam question answer help me solve integral equation history math "
+             "physics chemistry phone call message friend hello world what how when why where who please "
+             "send write read copy paste search book page chapter teacher student time minute").split()
+    vocab_file = os.path.join(tempfile.mkdtemp(prefix="tiny-nli-"), "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", "?"] + words))
+    tokenizer = BertTokenizerFast(vocab_file, model_max_length=128)
+    config = BertConfig(vocab_size=len(words) + 8, hidden_size=128, num_hidden_layers=4, num_attention_heads=4,
+                        intermediate_size=512, initializer_range=0.2, num_labels=3,
+                        id2label={0: "contradiction", 1: "neutral", 2: "entailment"},
+                        label2id={"contradiction": 0, "neutral": 1, "entailment": 2})
+    model = BertForSequenceClassification(config).eval()
+    return pipeline("zero-shot-classification", model=model, tokenizer=tokenizer)
+
+
+def synthetic_sentences(count: int, seed: int = 0, length: int = 12):
+    """Random sentences over the tiny_zero_shot_classifier vocabulary."""
+    import random
+    rng = random.Random(seed)
+    words = ("exam question answer help me solve integral equation history math physics phone call "
+             "message friend hello world what how please send write read book page teacher time").split()
+    return [" ".join(rng.choice(words) for _ in range(length)) for _ in range(count)]
@@ -0,0 +1,243 @@
+# Load test of every endpoint of main.py on a synthetic dataset
+# Seeds the database with benchmarks.synthetic_data, builds the reports with a full refresh, then sends
+# --requests requests from --concurrency concurrent clients through httpx's ASGI transport (in process, no
+# server or network). The report is written to --output as JSON: latency percentiles and throughput per
+# endpoint and overall, refresh durations, and peak RSS. With --baseline, the run is compared against an
+# earlier report and the script exits with status 1 when p95 latency, throughput or peak RSS got worse than
+# --tolerance, so it can catch regressions between commits.
+#
+# How the ML checks run during the refreshes (--ml):
+# - queue: they are left to report workers (REPORT_ML_EXECUTION=queue), only the API and database are measured.
+#   The response cache is off, as it needs Redis in that mode (see main.check_response_cache)
+# - tiny: tiny random models (see common.py). The screenshot check gets a stand-in that reads no title,
+#   as the document question answering model needs Tesseract
+# - pretrained: the real checkpoints of ml_utils (downloads them)
+#
+# python -m benchmarks.load_test [--uri mongodb://localhost:27017] [--concurrency 16] [--requests 2000]
+#                                [--ml queue] [--output load.json] [--baseline previous.json]
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from collections import defaultdict
+import httpx
+import db
+import report_utils
+import ml_utils as ML
+from benchmarks import synthetic_data
+from benchmarks.common import use_database, summarize, tiny_yolos, tiny_zero_shot_classifier, Timer
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process, or None when it cannot be measured
+    try:
+        import resource  # Unix only
+    except ImportError:
+        try:
+            import psutil  # Optional, gives the peak working set on Windows
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        return round(getattr(memory, "peak_wset", memory.rss) / 2**20, 1)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def exists_presence_flags(exam_name: str):
+    # db.get_presence_flags with one query per student and collection. mongomock does not implement
+    # $lookup with let, which the single aggregation relies on
+    return {
+        student: {name: db.exists(name, {"exam": exam_name, "student": student}) for name in db.PRESENCE_COLLECTIONS}
+        for student in db.get_distinct_values("test", "student", {"exam": exam_name})
+    }
+
+
+def use_ml(mode: str):
+    if mode == "queue":
+        report_utils.REPORT_ML_EXECUTION = "queue"
+    elif mode == "tiny":
+        ML.Models.image_processor, ML.Models.object_detection_model = tiny_yolos()
+        ML.Models.speech_classifier = tiny_zero_shot_classifier()
+        ML.Models.nlp = lambda image, question: [{"score": 0.0, "answer": ""}]
+
+
+def request_mix(database, rng: random.Random):
+    """{name: function returning the URL of a request}, one entry per endpoint and variant."""
+    exams = sorted(database["test"].distinct("exam"))
+    students = {exam: sorted(database["test"].distinct("student", {"exam": exam})) for exam in exams}
+    photo_ids = [str(photo["_id"]) for photo in database["periodicPhotos"].find({}, {"_id": 1}).limit(1000)]
+    screenshot_ids = [str(screenshot["_id"]) for screenshot in database["screenshot"].find({}, {"_id": 1}).limit(1000)]
+
+    def exam():
+        return rng.choice(exams)
+
+    def student():
+        exam_name = exam()
+        return f"{exam_name}/{rng.choice(students[exam_name])}"
+
+    return {
+        "exams": lambda: "/exams",
+        "reports": lambda: f"/reports/{exam()}",
+        "reports_page": lambda: f"/reports/{exam()}?limit=20",
+        "reports_failed": lambda: f"/reports/{exam()}?failed=outOfFrame,blur",
+        "summary": lambda: f"/reports/{exam()}/summary",
+        "student_report": lambda: f"/reports/{student()}",
+        "screenshot": lambda: f"/reports/{student()}/screenshot",
+        "out_of_frame": lambda: f"/reports/{student()}/out_of_frame",
+        "blur": lambda: f"/reports/{student()}/blur",
+        "blur_ndjson": lambda: f"/reports/{student()}/blur?format=ndjson",
+        "object_detection": lambda: f"/reports/{student()}/object_detection",
+        "speech_detection": lambda: f"/reports/{student()}/speech_detection",
+        "photo": lambda: f"/images/periodicPhotos/{rng.choice(photo_ids)}",
+        "photo_thumbnail": lambda: f"/images/periodicPhotos/{rng.choice(photo_ids)}?thumbnail=true",
+        "screenshot_image": lambda: f"/images/screenshot/{rng.choice(screenshot_ids)}",
+        "refresh_progress": lambda: "/reports/refresh/progress",
+        "models": lambda: "/models",
+        "metrics": lambda: "/metrics",
+    }
+
+
+async def run_refresh(client: httpx.AsyncClient, kind: str):
+    # Submit a refresh job and wait for it. Returns its duration and status
+    with Timer() as timer:
+        job = (await client.get(f"/reports/refresh/{kind}")).json()
+        while True:
+            status = (await client.get(f"/reports/refresh/jobs/{job['job_id']}")).json()
+            if status["status"] in ("done", "failed"):
+                break
+            await asyncio.sleep(0.05)
+    return {"seconds": round(timer.elapsed, 3), "status": status["status"], "exams": len(status["exams"])}
+
+
+async def run_load(client: httpx.AsyncClient, mix: dict, requests: int, concurrency: int):
+    """Closed loop: concurrency clients send the requests of the mix in turn, each waiting for its response."""
+    names = list(mix)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    sent = iter(range(requests))
+
+    async def client_loop():
+        for i in sent:
+            name = names[i % len(names)]
+            url = mix[name]()
+            start = time.perf_counter()
+            response = await client.get(url)
+            latencies[name].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[name] += 1
+
+    with Timer() as timer:
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    endpoints = {name: {**summarize(latencies[name], timer.elapsed), "errors": errors[name]} for name in names}
+    overall = summarize([latency for values in latencies.values() for latency in values], timer.elapsed)
+    return endpoints, {**overall, "errors": sum(errors.values())}
+
+
+async def run(args, database):
+    import main  # Imported once the database is set up
+    await main.app.router.startup()
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proctoring", timeout=None) as client:
+        # Step 1: Build the reports
+        refreshes = {"full": await run_refresh(client, "full")}
+        # Step 2: Load every endpoint
+        mix = request_mix(database, random.Random(args.seed))
+        results["endpoints"], results["overall"] = await run_load(client, mix, args.requests, args.concurrency)
+        # Step 3: New events for a tenth of the students, picked up by an incremental refresh
+        changed = database["test"].find({}, {"_id": 0, "exam": 1, "student": 1}).limit(max(1, args.exams * args.students // 10))
+        database["blur"].insert_many([{**student, "time": "2099-01-01T00:00:00.000Z", "msg": "New blur event"}
+                                      for student in changed])
+        refreshes["incremental"] = await run_refresh(client, "incremental")
+        refreshes["partial"] = await run_refresh(client, "partial")
+        results["refresh"] = refreshes
+    await main.app.router.shutdown()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Regressions of results against baseline, as readable lines."""
+    regressions = []
+    changed_settings = {key for key in ("database", "concurrency", "requests", "ml", "response_cache", "exams",
+                                        "students", "photos", "image_size")
+                        if baseline.get("settings", {}).get(key) != results["settings"][key]}
+    if changed_settings:
+        print(f"Warning: the baseline ran with different {', '.join(sorted(changed_settings))}", file=sys.stderr)
+    for name, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous and previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+    previous_rps = baseline.get("overall", {}).get("throughput_rps")
+    if previous_rps and results["overall"]["throughput_rps"] < previous_rps * (1 - tolerance):
+        regressions.append(f"throughput {previous_rps} -> {results['overall']['throughput_rps']} requests/s")
+    previous_rss = baseline.get("peak_rss_mb")
+    if previous_rss and results["peak_rss_mb"] and results["peak_rss_mb"] > previous_rss * (1 + tolerance):
+        regressions.append(f"peak RSS {previous_rss}MB -> {results['peak_rss_mb']}MB")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Load test every endpoint on a synthetic dataset")
+    arg_parser.add_argument("--uri", help="Local mongod URI. Uses mongomock when omitted")
+    arg_parser.add_argument("--keep-data", action="store_true",
+                            help="test the data already in the benchmark database instead of clearing and reseeding it")
+    arg_parser.add_argument("--concurrency", type=int, default=16)
+    arg_parser.add_argument("--requests", type=int, default=2000)
+    arg_parser.add_argument("--ml", choices=("queue", "tiny", "pretrained"), default="queue")
+    arg_parser.add_argument("--no-response-cache", action="store_true", help="serve every request from the database")
+    arg_parser.add_argument("--output", default="load_test.json")
+    arg_parser.add_argument("--baseline", help="report of an earlier run to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2, help="accepted relative regression")
+    arg_parser.add_argument("--verbose", action="store_true", help="keep the application's INFO logs")
+    synthetic_data.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    database = use_database(args.uri)
+    if not args.uri:
+        db.get_presence_flags = exists_presence_flags
+    # Start from an empty database, reports included
+    if not args.keep_data:
+        for name in database.list_collection_names():
+            database[name].delete_many({})
+    with Timer() as seeding:
+        documents = {} if args.keep_data else synthetic_data.generate(database, args)
+    rss_after_seeding = peak_rss_mb()
+    use_ml(args.ml)
+    from cache_utils import response_cache
+    response_cache.enabled = not args.no_response_cache
+
+    results = asyncio.run(run(args, database))
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["peak_rss_after_seeding_mb"] = rss_after_seeding
+    results["dataset"] = {"documents": documents, "seconds": round(seeding.elapsed, 2)}
+    results["settings"] = {
+        "database": "mongod" if args.uri else "mongomock", "concurrency": args.concurrency, "requests": args.requests,
+        "ml": args.ml, "response_cache": response_cache.enabled, "exams": args.exams, "students": args.students,
+        "photos": args.photos, "image_size": list(args.image_size), "seed": args.seed,
+        "python": platform.python_version(), "machine": platform.machine(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({"overall": results["overall"], "refresh": results["refresh"],
+                      "peak_rss_mb": results["peak_rss_mb"]}, indent=2))
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Synthetic proctoring dataset generator
+# Fills a local mongod, or an in-memory mongomock, with exams shaped like the ones the front-end records:
+# every student gets a test document with the exam themes, a periodic photo every PHOTO_INTERVAL_SECONDS
+# (real base64 JPEGs, held still for a few frames like a webcam), out of frame windows, blur events,
+# conversation snippets, usually a screenshot, and for some students object detection captures.
+#
+# python -m benchmarks.synthetic_data --uri mongodb://localhost:27017 [--students 50] [--photos 100] [--clear]
+
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+from benchmarks.common import use_database, synthetic_jpeg_data_url, synthetic_sentences, Timer
+
+PHOTO_INTERVAL_SECONDS = 10
+# Periodic photos of a student stay the same for this many frames before the picture changes
+STILL_FRAMES = 5
+THEMES = "math,history,physics"
+# Collections written by the generator
+COLLECTIONS = ["test", "periodicPhotos", "outOfFrame", "blur", "conversations", "screenshot", "ObjectDetectionData"]
+
+
+def timestamp(moment: datetime):
+    # ISO 8601 in UTC, as sent by the front-end
+    return moment.isoformat(timespec="milliseconds") + "Z"
+
+
+def exam_name(index: int):
+    return f"Synthetic exam {index + 1}"
+
+
+def student_email(index: int):
+    return f"student{index:05d}@fi.uba.ar"
+
+
+def student_documents(exam: str, student: str, start: datetime, images: list, args, rng: random.Random):
+    """Every document of one student's exam, by collection."""
+    documents = {name: [] for name in COLLECTIONS}
+    documents["test"].append({"exam": exam, "student": student, "themes": THEMES})
+    # A webcam photo every PHOTO_INTERVAL_SECONDS, changing every STILL_FRAMES frames
+    first_image = rng.randrange(len(images))
+    for i in range(args.photos):
+        documents["periodicPhotos"].append({
+            "exam": exam, "student": student, "time": timestamp(start + timedelta(seconds=i * PHOTO_INTERVAL_SECONDS)),
+            "image": images[(first_image + i // STILL_FRAMES) % len(images)],
+        })
+    duration = args.photos * PHOTO_INTERVAL_SECONDS
+    for _ in range(rng.randint(0, args.out_of_frame)):
+        documents["outOfFrame"].append({"exam": exam, "student": student,
+                                        "time": timestamp(start + timedelta(seconds=rng.uniform(0, duration))),
+                                        "duration": rng.randint(5, 60)})
+    for _ in range(rng.randint(0, args.blur)):
+        documents["blur"].append({"exam": exam, "student": student,
+                                  "time": timestamp(start + timedelta(seconds=rng.uniform(0, duration))),
+                                  "msg": "The camera image is blurry"})
+    snippets = synthetic_sentences(rng.randint(0, args.conversations), seed=rng.randrange(2**32))
+    for snippet in snippets:
+        documents["conversations"].append({"exam": exam, "student": student,
+                                           "time": timestamp(start + timedelta(seconds=rng.uniform(0, duration))),
+                                           "conversation": snippet})
+    if rng.random() < args.screenshot_ratio:
+        documents["screenshot"].append({"exam": exam, "student": student, "time": timestamp(start),
+                                        "image": rng.choice(images)})
+    if rng.random() < args.object_detection_ratio:
+        for _ in range(rng.randint(1, 3)):
+            documents["ObjectDetectionData"].append({"exam": exam, "student": student,
+                                                     "time": timestamp(start + timedelta(seconds=rng.uniform(0, duration))),
+                                                     "image": rng.choice(images)})
+    return documents
+
+
+def generate(database, args, clear: bool = False):
+    """Write the dataset described by args into database. Returns the number of documents per collection."""
+    rng = random.Random(args.seed)
+    width, height = args.image_size
+    images = [synthetic_jpeg_data_url(width, height, seed=args.seed + i) for i in range(args.distinct_images)]
+    if clear:
+        for name in COLLECTIONS:
+            database[name].delete_many({})
+    counts = dict.fromkeys(COLLECTIONS, 0)
+    start = datetime(2023, 9, 1, 10, 0)
+    for e in range(args.exams):
+        exam = exam_name(e)
+        for s in range(args.students):
+            documents = student_documents(exam, student_email(s), start + timedelta(days=e), images, args, rng)
+            for name, batch in documents.items():
+                if batch:
+                    database[name].insert_many(batch, ordered=False)
+                    counts[name] += len(batch)
+    return counts
+
+
+def add_arguments(arg_parser: argparse.ArgumentParser):
+    """Dataset size options, shared with the load test."""
+    arg_parser.add_argument("--exams", type=int, default=2)
+    arg_parser.add_argument("--students", type=int, default=50, help="students per exam")
+    arg_parser.add_argument("--photos", type=int, default=40, help="periodic photos per student")
+    arg_parser.add_argument("--image-size", type=int, nargs=2, default=(320, 240), metavar=("WIDTH", "HEIGHT"))
+    arg_parser.add_argument("--distinct-images", type=int, default=16, help="different JPEGs the photos are drawn from")
+    arg_parser.add_argument("--out-of-frame", type=int, default=5, help="most out of frame windows per student")
+    arg_parser.add_argument("--blur", type=int, default=10, help="most blur events per student")
+    arg_parser.add_argument("--conversations", type=int, default=8, help="most conversation snippets per student")
+    arg_parser.add_argument("--screenshot-ratio", type=float, default=0.9, help="share of students with a screenshot")
+    arg_parser.add_argument("--object-detection-ratio", type=float, default=0.2,
+                            help="share of students with object detection captures")
+    arg_parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Fill a database with a synthetic proctoring dataset")
+    arg_parser.add_argument("--uri", help="Local mongod URI. Uses mongomock when omitted")
+    arg_parser.add_argument("--clear", action="store_true", help="delete the existing documents of these collections first")
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    database = use_database(args.uri)
+    with Timer() as timer:
+        counts = generate(database, args, args.clear)
+    print(json.dumps({"documents": counts, "seconds": round(timer.elapsed, 2)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# CACHING
+
+import os
+import time
+import json
+import threading
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+import db
+
+
+class TTLCache:
+    """A small thread-safe in-process cache whose entries expire after ttl_seconds."""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        """Store value under key for ttl_seconds."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+
+    def invalidate(self, key=None):
+        """Drop one key, or every entry when no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+# Exam names rarely change, the front-end asks for them on every load
+exam_names_cache = TTLCache(ttl_seconds=float(os.getenv("EXAMS_CACHE_TTL_SECONDS", "60")))
+
+
+class InferenceCache:
+    """Persistent cache of model outputs, in the inferenceCache collection.
+    Entries are keyed by the hash of the model input plus the model name and version, so the same
+    photo, screenshot or snippet is never run through the same model twice. Unused entries expire
+    through a TTL index on last_used_at (see db.INDEXES)."""
+
+    # Hashes looked up per query
+    LOOKUP_CHUNK_SIZE = 1000
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+
+    @staticmethod
+    def content_hash(*parts: str):
+        """SHA-256 of the given strings. Hashing the base64 text avoids decoding the image first."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get_many(self, model: str, content_hashes: list):
+        """Return {content_hash: result} for the hashes already cached for model."""
+        if not self.enabled:
+            return {}
+        results = {}
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        for start in range(0, len(unique_hashes), self.LOOKUP_CHUNK_SIZE):
+            chunk = unique_hashes[start:start + self.LOOKUP_CHUNK_SIZE]
+            query = {"model": model, "content_hash": {"$in": chunk}}
+            entries = db.get_mongo_collection("inferenceCache", query, {"content_hash": 1, "result": 1, "_id": 0})
+            for entry in entries:
+                results[entry["content_hash"]] = entry["result"]
+            # Keep the entries that were just used away from the TTL eviction, in one write per chunk
+            if entries:
+                db.update_mongo_collection("inferenceCache", query, {"$set": {"last_used_at": datetime.utcnow()}}, many=True)
+        return results
+
+    def get(self, model: str, content_hash: str):
+        """Return the cached result, or None."""
+        return self.get_many(model, [content_hash]).get(content_hash)
+
+    def put_many(self, model: str, results: dict):
+        """Store {content_hash: result} for model."""
+        if not self.enabled or not results:
+            return
+        now = datetime.utcnow()
+        db.insert_many_into_mongo_collection("inferenceCache", [
+            {"content_hash": content_hash, "model": model, "result": result, "last_used_at": now}
+            for content_hash, result in results.items()
+        ])
+
+    def put(self, model: str, content_hash: str, result):
+        """Store a single result."""
+        self.put_many(model, {content_hash: result})
+
+
+inference_cache = InferenceCache(enabled=os.getenv("INFERENCE_CACHE_ENABLED", "true").lower() == "true")
+
+
+class MemoryStore:
+    """In-process LRU store of byte strings, bounded by the total size of the values."""
+
+    remote = False
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at), least recently used first
+        self._size = 0
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        # A value taking more than a quarter of the budget would evict most of the cache, skip it
+        if len(value) > self.max_bytes // 4:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (value, time.monotonic() + ttl_seconds)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def counters(self, names: list):
+        with self._lock:
+            return [self._counters.get(name, 0) for name in names]
+
+    def increment(self, name: str):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+
+class RedisStore:
+    """The same store on a Redis-compatible server (Redis, Valkey, KeyDB...), shared by every API worker.
+    The byte budget is the server's maxmemory, with an LRU maxmemory-policy such as allkeys-lru."""
+
+    remote = True
+
+    def __init__(self, url: str, prefix: str = "proctoring:"):
+        import redis  # Optional dependency (requirements-optional.txt), only needed with RESPONSE_CACHE_REDIS_URL
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: float):
+        self.client.set(self.prefix + key, value, px=int(ttl_seconds * 1000))
+
+    def counters(self, names: list):
+        return [int(value or 0) for value in self.client.mget([self.prefix + name for name in names])]
+
+    def increment(self, name: str):
+        self.client.incr(self.prefix + name)
+
+
+class ResponseCache:
+    """Cache of serialized endpoint responses, keyed by endpoint, exam, student and request variant
+    (query string). Every exam has a generation counter that is part of the keys: invalidating an exam
+    bumps it, so its old responses are never read again and age out of the store. Entries also expire
+    after ttl_seconds, which bounds staleness for data written outside the report refreshes."""
+
+    def __init__(self, store, ttl_seconds: float, enabled: bool = True):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+
+    def key(self, endpoint: str, test_name: str, student_email: str = None, variant: str = ""):
+        """Key of a response under the current generations. Resolve it once per request, before building the
+        response, so a response built while the exam is invalidated is stored under the old generation."""
+        generation, exam_generation = self.store.counters(["generation", f"generation:{test_name}"])
+        return f"response:{generation}.{exam_generation}:{endpoint}:{test_name}:{student_email or ''}:{variant}"
+
+    def get(self, key: str):
+        """Return the cached (body, media_type, headers), or None."""
+        if not self.enabled:
+            return None
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        meta, _, body = entry.partition(b"\n")
+        meta = json.loads(meta)
+        return body, meta["media_type"], meta["headers"]
+
+    def set(self, key: str, body: bytes, media_type: str, headers: dict):
+        if not self.enabled:
+            return
+        meta = json.dumps({"media_type": media_type, "headers": headers}).encode()
+        self.store.set(key, meta + b"\n" + body, self.ttl_seconds)
+
+    def invalidate(self, test_name: str = None):
+        """Forget the responses of one exam, or of every exam when no name is given."""
+        if self.enabled:
+            self.store.increment(f"generation:{test_name}" if test_name is not None else "generation")
+
+    @staticmethod
+    def etag(body: bytes):
+        return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def _response_store():
+    redis_url = os.getenv("RESPONSE_CACHE_REDIS_URL")
+    if redis_url:
+        return RedisStore(redis_url)
+    return MemoryStore(max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_MB", "64")) * 2**20)
+
+# Report and detail responses. Data of a finished exam does not change, so they are served from here
+# until a report refresh or incremental update writes to the exam
+response_cache = ResponseCache(
+    _response_store(),
+    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300")),
+    enabled=os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true",
+)
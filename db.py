@@ -1,45 +1,314 @@
 # Module for database communication
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne, ReturnDocument
 import os
+import time
+from functools import wraps
 from dotenv import load_dotenv
-from bson import json_util
-import json
-from project_utils import Logger, ErrorHandler  # Import the Logger and ErrorHandler
+from bson import json_util, BSON
+from project_utils import Logger, ErrorHandler, metrics  # Import the Logger and ErrorHandler
 
 load_dotenv()
 
 mongodb_uri = os.getenv("MONGODB_URI")
-client = MongoClient(mongodb_uri)
+
+# Connection pool settings. Every value can be overridden from the environment
+POOL_SETTINGS = {
+    "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "60000")),
+    "waitQueueTimeoutMS": int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "10000")),
+    "connectTimeoutMS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "10000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+    "socketTimeoutMS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000")),
+    "retryReads": os.getenv("MONGODB_RETRY_READS", "true").lower() == "true",
+    "retryWrites": os.getenv("MONGODB_RETRY_WRITES", "true").lower() == "true",
+}
+
+client = MongoClient(mongodb_uri, **POOL_SETTINGS)
 db = client["proctoring"]
 
-VALID_COLLECTIONS = ["blur", "conversations", "firstPhoto", "screenshot","test","periodicPhotos","outOfFrame","reports","ObjectDetectionData"]
+VALID_COLLECTIONS = ["blur", "conversations", "firstPhoto", "screenshot","test","periodicPhotos","outOfFrame","reports","ObjectDetectionData","reportsStaging","reportWatermarks","inferenceCache","reportSummaries","reportSummariesStaging","reportTasks","reportTailer"]
+
+# Indexes needed by every collection, as (keys, options) pairs. All lookups filter on exam and student
+# and most event lists are read in time order
+# _id is the tiebreaker of the keyset pagination on time, so it is part of the key
+STUDENT_EVENTS_INDEX = ([("exam", ASCENDING), ("student", ASCENDING), ("time", ASCENDING), ("_id", ASCENDING)], {})
+INDEXES = {
+    "blur": [STUDENT_EVENTS_INDEX],
+    "conversations": [STUDENT_EVENTS_INDEX],
+    "firstPhoto": [([("exam", ASCENDING), ("student", ASCENDING)], {})],
+    "screenshot": [STUDENT_EVENTS_INDEX],
+    "test": [([("exam", ASCENDING), ("student", ASCENDING)], {})],
+    "periodicPhotos": [STUDENT_EVENTS_INDEX],
+    "outOfFrame": [STUDENT_EVENTS_INDEX],
+    # One document per (test, student). failed lists the checks the student failed, for the filtered listing
+    "reports": [
+        ([("test", ASCENDING), ("student", ASCENDING)], {"unique": True}),
+        ([("test", ASCENDING), ("failed", ASCENDING), ("student", ASCENDING)], {}),
+    ],
+    "reportSummaries": [([("test", ASCENDING)], {"unique": True})],
+    # Work queue of the report workers (see queue_utils)
+    "reportTasks": [
+        ([("exam", ASCENDING), ("student", ASCENDING), ("check", ASCENDING)], {"unique": True}),
+        ([("status", ASCENDING), ("queued_at", ASCENDING)], {}),
+        ([("exam", ASCENDING), ("status", ASCENDING)], {}),
+    ],
+    "ObjectDetectionData": [
+        STUDENT_EVENTS_INDEX,
+        ([("exam", ASCENDING), ("student", ASCENDING), ("time", ASCENDING)], {"unique": True}),
+    ],
+    "reportWatermarks": [
+        ([("exam", ASCENDING), ("student", ASCENDING), ("collection", ASCENDING)], {"unique": True}),
+        ([("collection", ASCENDING), ("last_id", ASCENDING)], {}),
+    ],
+    # How far the incremental refresh has scanned each source collection
+    "reportTailer": [([("collection", ASCENDING)], {"unique": True})],
+    # Entries not used for INFERENCE_CACHE_TTL_DAYS are evicted by the server
+    "inferenceCache": [
+        ([("content_hash", ASCENDING), ("model", ASCENDING)], {"unique": True}),
+        ([("last_used_at", ASCENDING)], {"expireAfterSeconds": int(os.getenv("INFERENCE_CACHE_TTL_DAYS", "30")) * 86400}),
+    ],
+}
+
+# Fields identifying a document of the collections this service writes to. Writes are upserts on these
+# keys (backed by the unique indexes above), so writing the same document twice is harmless
+NATURAL_KEYS = {
+    "ObjectDetectionData": ["exam", "student", "time"],
+    "reports": ["test", "student"],
+    "reportsStaging": ["test", "student"],
+    "reportSummaries": ["test"],
+    "reportSummariesStaging": ["test"],
+    "reportTasks": ["exam", "student", "check"],
+    "reportTailer": ["collection"],
+    "inferenceCache": ["content_hash", "model"],
+}
+
+# Indexes of earlier layouts that conflict with the ones above, dropped by ensure_indexes.
+# reports used to hold a single document per test
+LEGACY_INDEXES = {"reports": ["test_1"]}
+
+# The queries issued by the endpoints and the report generation, as (collection, filter, sort).
+# Used by verify_query_plans to make sure none of them falls back to a collection scan
+STUDENT_QUERY = {"exam": "", "student": ""}
+TIME_ORDER = [("time", ASCENDING), ("_id", ASCENDING)]
+ENDPOINT_QUERIES = [
+    ("reports", {"test": ""}, [("student", ASCENDING)]),
+    ("reports", {"test": "", "student": ""}, None),
+    ("reports", {"test": "", "failed": {"$all": [""]}}, [("student", ASCENDING)]),
+    ("reportSummaries", {"test": ""}, None),
+    ("reportTasks", {"status": "queued"}, [("queued_at", ASCENDING)]),
+    ("test", STUDENT_QUERY, None),
+    ("screenshot", STUDENT_QUERY, None),
+    ("outOfFrame", STUDENT_QUERY, TIME_ORDER),
+    ("periodicPhotos", STUDENT_QUERY, None),
+    ("blur", STUDENT_QUERY, TIME_ORDER),
+    ("ObjectDetectionData", STUDENT_QUERY, TIME_ORDER),
+    ("conversations", STUDENT_QUERY, TIME_ORDER),
+]
+
+# Whether mongo_bytes_returned_total is recorded. Re-encoding the documents to measure them is cheap but not free
+METRICS_COUNT_BYTES = os.getenv("METRICS_COUNT_BYTES", "true").lower() == "true"
+
+def timed_operation(operation: str):
+    # Decorator recording the duration of a Mongo operation, labelled with the collection (first argument)
+    def decorator(func):
+        @wraps(func)
+        def wrapper(collection_name, *args, **kwargs):
+            with metrics.timer("mongo_query_duration_seconds", collection=collection_name, operation=operation):
+                return func(collection_name, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_documents(collection_name: str, documents: list):
+    # Count the documents (and their BSON size) read from a collection
+    metrics.increment("mongo_documents_returned_total", len(documents), collection=collection_name)
+    if METRICS_COUNT_BYTES and metrics.enabled:
+        metrics.increment("mongo_bytes_returned_total", sum(len(BSON.encode(document)) for document in documents),
+                          collection=collection_name)
 
-def get_mongo_collection(collection_name: str, query: dict = None):
+# Types that are already JSON-safe and can be returned untouched
+JSON_NATIVE_TYPES = (str, int, float, bool, type(None))
+
+def to_json_safe(value):
+    """Convert a BSON document to plain JSON types, field by field.
+    Produces the same shape as json.loads(json_util.dumps(value)) (ObjectId -> {"$oid": ...},
+    datetime -> {"$date": ...}) without serializing large strings such as base64 images twice."""
+    if isinstance(value, JSON_NATIVE_TYPES):
+        return value
+    if isinstance(value, dict):
+        return {key: to_json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(item) for item in value]
+    # Any other BSON type (ObjectId, datetime, Int64, Binary...) uses the extended JSON encoding
+    return to_json_safe(json_util.default(value))
+
+@timed_operation("find")
+def get_mongo_collection(collection_name: str, query: dict = None, projection: dict = None,
+                         sort: list = None, limit: int = 0, skip: int = 0):
     # Ensure the collection name is valid
     if collection_name not in VALID_COLLECTIONS:
         raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
     # Fetch the collection based on the provided name
     collection = db[collection_name]
     # If a query dictionary was passed, use it to filter the documents
-    documents = list(collection.find(query or {}))
+    # The projection, sort, skip and limit are applied server-side so only the requested fields travel
+    documents = collection.find(query or {}, projection)
+    if sort:
+        documents = documents.sort(sort)
+    if skip:
+        documents = documents.skip(skip)
+    if limit:
+        documents = documents.limit(limit)
+
+    documents = list(documents)
+    record_documents(collection_name, documents)
+    return [to_json_safe(document) for document in documents]
+
+# Documents fetched per round trip when a cursor is consumed in batches
+BATCH_SIZE = int(os.getenv("MONGODB_BATCH_SIZE", "200"))
 
-    return json.loads(json_util.dumps(documents))
+def find_batches(collection_name: str, query: dict = None, projection: dict = None,
+                 sort: list = None, limit: int = 0, batch_size: int = BATCH_SIZE):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    # Yield the matching documents in lists of at most batch_size, so only one batch is held in memory
+    cursor = db[collection_name].find(query or {}, projection).batch_size(batch_size)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    try:
+        batch = []
+        # Only the time spent fetching a batch is recorded, not the time the consumer holds it
+        start = time.perf_counter()
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == batch_size:
+                metrics.observe("mongo_query_duration_seconds", time.perf_counter() - start, collection=collection_name, operation="find_batch")
+                record_documents(collection_name, batch)
+                yield [to_json_safe(document) for document in batch]
+                batch = []
+                start = time.perf_counter()
+        if batch:
+            metrics.observe("mongo_query_duration_seconds", time.perf_counter() - start, collection=collection_name, operation="find_batch")
+            record_documents(collection_name, batch)
+            yield [to_json_safe(document) for document in batch]
+    finally:
+        cursor.close()
 
+@timed_operation("count")
+def count(collection_name: str, query: dict = None, limit: int = 0):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    # With a limit the server stops counting as soon as it is reached
+    options = {"limit": limit} if limit else {}
+    return db[collection_name].count_documents(query or {}, **options)
+
+def exists(collection_name: str, query: dict = None):
+    # Whether any document matches, without fetching it
+    return count(collection_name, query, limit=1) > 0
+
+# Collections whose mere presence of documents decides a check
+PRESENCE_COLLECTIONS = ["outOfFrame", "blur", "conversations"]
+
+def get_presence_flags(exam_name: str):
+    # For every student of an exam, whether they have any outOfFrame, blur and conversations documents.
+    # One aggregation over the test collection, each lookup stops at the first matching document
+    pipeline = [
+        {"$match": {"exam": exam_name}},
+        {"$group": {"_id": "$student"}},
+    ]
+    for collection_name in PRESENCE_COLLECTIONS:
+        pipeline.append({"$lookup": {
+            "from": collection_name,
+            "let": {"student": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [{"$eq": ["$exam", {"$literal": exam_name}]}, {"$eq": ["$student", "$$student"]}]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}},
+            ],
+            "as": collection_name,
+        }})
+    pipeline.append({"$project": {
+        collection_name: {"$gt": [{"$size": f"${collection_name}"}, 0]} for collection_name in PRESENCE_COLLECTIONS
+    }})
+    return {
+        flags.pop("_id"): flags
+        for flags in aggregate_mongo_collection("test", pipeline)
+    }
+
+@timed_operation("distinct")
+def get_distinct_values(collection_name: str, field: str, query: dict = None):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    # Let the server compute the distinct values instead of loading every document
+    return [to_json_safe(value) for value in db[collection_name].distinct(field, query or {})]
+
+@timed_operation("aggregate")
+def aggregate_mongo_collection(collection_name: str, pipeline: list):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    documents = list(db[collection_name].aggregate(pipeline))
+    record_documents(collection_name, documents)
+    return [to_json_safe(document) for document in documents]
+
+@timed_operation("update")
+def update_mongo_collection(collection_name: str, query: dict, update: dict, upsert: bool = False, many: bool = False):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    try:
+        # Apply the update to the first (or, with many, every) matching document and return how many matched
+        if many:
+            return db[collection_name].update_many(query, update, upsert=upsert).matched_count
+        return db[collection_name].update_one(query, update, upsert=upsert).matched_count
+    except Exception as e:
+        raise ErrorHandler.DatabaseConnectionError(f"Error updating data in {collection_name} collection: {str(e)}")
+
+def _natural_key(collection_name: str, data: dict):
+    # Filter matching the document with the same natural key as data
+    return {field: data[field] for field in NATURAL_KEYS[collection_name]}
+
+@timed_operation("insert")
 def insert_into_mongo_collection(collection_name: str, data: dict):
     # Ensure the collection name is valid
     if collection_name not in VALID_COLLECTIONS:
         raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
     try:
-        existing_data = get_mongo_collection(collection_name, data)
+        collection = db[collection_name]
+        if collection_name in NATURAL_KEYS:
+            # Upsert on the natural key: no read before the write, and no race between two writers
+            collection.update_one(_natural_key(collection_name, data), {"$set": data}, upsert=True)
+        else:
+            collection.insert_one(data)
+    except Exception as e:
+        raise ErrorHandler.DatabaseConnectionError(f"Error inserting data into {collection_name} collection: {str(e)}")
 
-        if existing_data:
-            return  # If the data already exists, simply return without inserting
+@timed_operation("insert_many")
+def insert_many_into_mongo_collection(collection_name: str, documents: list):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    if not documents:
+        return
+    try:
         collection = db[collection_name]
-        collection.insert_one(data)
+        # Unordered, so one failing document does not stop the rest of the batch
+        if collection_name in NATURAL_KEYS:
+            collection.bulk_write([
+                UpdateOne(_natural_key(collection_name, data), {"$set": data}, upsert=True) for data in documents
+            ], ordered=False)
+        else:
+            collection.insert_many(documents, ordered=False)
     except Exception as e:
         raise ErrorHandler.DatabaseConnectionError(f"Error inserting data into {collection_name} collection: {str(e)}")
     
+@timed_operation("delete")
 def clear_mongo_collection(collection_name: str):
     # Ensure the collection name is valid
     if collection_name not in VALID_COLLECTIONS:
@@ -48,4 +317,92 @@ def clear_mongo_collection(collection_name: str):
         collection = db[collection_name]
         collection.delete_many({})
     except Exception as e:
-        raise ErrorHandler.DatabaseConnectionError(f"Error clearing {collection_name} collection: {str(e)}")    
\ No newline at end of file
+        raise ErrorHandler.DatabaseConnectionError(f"Error clearing {collection_name} collection: {str(e)}")
+
+@timed_operation("find_one_and_update")
+def find_one_and_update(collection_name: str, query: dict, update: dict, sort: list = None):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    try:
+        # Atomically update the first matching document (in sort order) and return it as updated, or None
+        document = db[collection_name].find_one_and_update(query, update, sort=sort, return_document=ReturnDocument.AFTER)
+    except Exception as e:
+        raise ErrorHandler.DatabaseConnectionError(f"Error updating data in {collection_name} collection: {str(e)}")
+    return to_json_safe(document) if document is not None else None
+
+@timed_operation("delete")
+def delete_from_mongo_collection(collection_name: str, query: dict):
+    # Ensure the collection name is valid
+    if collection_name not in VALID_COLLECTIONS:
+        raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {collection_name}")
+    try:
+        return db[collection_name].delete_many(query).deleted_count
+    except Exception as e:
+        raise ErrorHandler.DatabaseConnectionError(f"Error deleting data from {collection_name} collection: {str(e)}")
+
+def ensure_indexes():
+    # Drop the LEGACY_INDEXES still around, then create the indexes listed in INDEXES.
+    # create_index is a no-op when the index already exists. A failing collection does not stop the others,
+    # the failures are raised together at the end
+    failures = []
+    for collection_name, index_names in LEGACY_INDEXES.items():
+        try:
+            existing = db[collection_name].index_information()
+            for index_name in index_names:
+                if index_name in existing:
+                    db[collection_name].drop_index(index_name)
+        except Exception as e:
+            failures.append(f"dropping legacy indexes on {collection_name}: {str(e)}")
+    for collection_name, indexes in INDEXES.items():
+        try:
+            for keys, options in indexes:
+                db[collection_name].create_index(keys, **options)
+        except Exception as e:
+            failures.append(f"creating indexes on {collection_name}: {str(e)}")
+    if failures:
+        raise ErrorHandler.DatabaseConnectionError(f"Error ensuring indexes, {len(failures)} failed: {'; '.join(failures)}")
+
+def replace_collection(collection_name: str, staging_name: str):
+    # Ensure the collection names are valid
+    for name in (collection_name, staging_name):
+        if name not in VALID_COLLECTIONS:
+            raise ErrorHandler.InvalidCollectionError(f"Invalid collection name: {name}")
+    try:
+        # Give the staging collection the indexes of the one it replaces (this also creates it when empty),
+        # then swap it in. renameCollection with dropTarget is atomic, readers never see an empty collection
+        for keys, options in INDEXES.get(collection_name, []):
+            db[staging_name].create_index(keys, **options)
+        db[staging_name].rename(collection_name, dropTarget=True)
+    except Exception as e:
+        raise ErrorHandler.DatabaseConnectionError(f"Error replacing {collection_name} collection with {staging_name}: {str(e)}")
+
+def _plan_stages(plan):
+    # Walk an explain() plan tree and yield the name of every stage in it
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+def verify_query_plans(queries: list = None):
+    # Explain every endpoint query and fail loudly if any of them would scan the whole collection
+    collection_scans = []
+    for collection_name, query, sort in queries or ENDPOINT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            collection_scans.append(f"{collection_name} {query}")
+    if collection_scans:
+        raise ErrorHandler.QueryPlanError(f"Queries falling back to a collection scan: {'; '.join(collection_scans)}")
+
+if __name__ == "__main__":
+    # Maintenance entry point: python db.py
+    ensure_indexes()
+    verify_query_plans()
+    print("Indexes created and every endpoint query uses an index.")
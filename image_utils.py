@@ -0,0 +1,110 @@
+# Module for image handling
+# The front-end stores every image as a base64 data URL ("data:image/jpeg;base64,...")
+
+import base64
+import os
+from io import BytesIO
+from PIL import Image
+from project_utils import Logger, ErrorHandler  # Import the Logger and ErrorHandler
+
+logger = Logger(__name__)
+
+# Collections whose documents hold an "image" data URL that may be served by the image endpoints
+IMAGE_COLLECTIONS = ["firstPhoto", "screenshot", "periodicPhotos", "ObjectDetectionData"]
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "160"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+STREAM_CHUNK_SIZE = 64 * 1024
+# Side of the difference hash grid, frame_signature returns HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def split_data_url(data_url: str):
+    """Return (media_type, raw bytes) for a base64 data URL."""
+    header, _, payload = data_url.partition(",")
+    if not payload:
+        # Some clients store the bare base64 string without the data URL header
+        header, payload = "data:image/jpeg;base64", data_url
+    media_type = header[len("data:"):].split(";")[0] or "image/jpeg"
+    return media_type, base64.b64decode(payload)
+
+
+def model_input_size(image_processor):
+    """Shortest side, in pixels, an image processor resizes its inputs to (None when it does not say)."""
+    size = getattr(image_processor, "size", None) or {}
+    if "shortest_edge" in size:
+        return size["shortest_edge"]
+    if "height" in size and "width" in size:
+        return min(size["height"], size["width"])
+    return None
+
+
+def open_image(image_bytes: bytes, draft_size: int = None):
+    """Decode image bytes to RGB. With draft_size, a JPEG is decoded at the smallest 1/2, 1/4 or 1/8
+    scale whose shortest side is still at least draft_size, so no full-resolution pixels are produced
+    for a model that downscales them anyway."""
+    image = Image.open(BytesIO(image_bytes))
+    if draft_size:
+        width, height = image.size
+        scale = draft_size / min(width, height)
+        image.draft("RGB", (int(width * scale), int(height * scale)))
+    return image.convert("RGB")
+
+
+def decode_data_url(data_url: str, draft_size: int = None):
+    """Decode a base64 data URL to an RGB image, see open_image."""
+    _, image_bytes = split_data_url(data_url)
+    return open_image(image_bytes, draft_size)
+
+
+def decode_ahead(items, data_urls, pool, draft_size: int = None):
+    """Yield (item, images) for each item of an iterable, e.g. the batches of db.find_batches.
+    data_urls(item) returns the data URLs to decode for an item. They are decoded on pool while the
+    caller works on the previous item, so at most two items' images are in memory at any time."""
+    pending = None
+    for item in items:
+        futures = [pool.submit(decode_data_url, data_url, draft_size) for data_url in data_urls(item)]
+        if pending is not None:
+            yield pending[0], [future.result() for future in pending[1]]
+        pending = (item, futures)
+    if pending is not None:
+        yield pending[0], [future.result() for future in pending[1]]
+
+
+def frame_signature(data_url: str, hash_size: int = HASH_SIZE):
+    """Difference hash of an image: one bit per pair of horizontally adjacent pixels of a
+    (hash_size + 1) x hash_size grayscale thumbnail, set when brightness increases left to right.
+    Near-identical frames get hashes a few bits apart. Decoding is drafted down to a few dozen pixels."""
+    image = Image.open(BytesIO(split_data_url(data_url)[1]))
+    image.draft("L", (hash_size * 4, hash_size * 4))
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    signature = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            signature = signature << 1 | (pixels[row * (hash_size + 1) + column + 1] > left)
+    return signature
+
+
+def signature_distance(first: int, second: int):
+    """Number of differing bits between two frame signatures."""
+    return bin(first ^ second).count("1")
+
+
+def make_thumbnail(image_bytes: bytes, size: int = THUMBNAIL_SIZE):
+    """Downscale an image so that its longest side is at most size pixels and encode it as JPEG."""
+    image = Image.open(BytesIO(image_bytes))
+    # Let the JPEG decoder skip detail we are about to throw away
+    image.draft("RGB", (size, size))
+    image = image.convert("RGB")
+    image.thumbnail((size, size))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+
+def iter_chunks(data: bytes, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Yield data in chunk_size slices, so a response never copies the whole image at once."""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
@@ -1,30 +1,44 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.routing import Match
 from pymongo import MongoClient
+from bson import ObjectId, json_util
 import os
 # import database utilities
 from dotenv import load_dotenv
 from fastapi.encoders import jsonable_encoder
 import json
-# import machine learning models
-from transformers import pipeline
-from transformers import AutoImageProcessor, AutoModelForObjectDetection
 from PIL import Image
 from io import BytesIO
 import base64
 # import project utilities
 from datetime import datetime, timedelta
 from dateutil import parser
+from bisect import bisect_left, bisect_right
 import logging 
+import asyncio
+import re
+import time
 import db
+import async_db
 import os
 import ml_utils as ML 
-from project_utils import Logger, ErrorHandler  # <-- Importing Logger and ErrorHandler
+import image_utils
+import report_utils
+from cache_utils import exam_names_cache, response_cache
+from report_utils import report_scheduler, refresh_jobs, migrate_legacy_reports, CHECK_ORDER
+from project_utils import Logger, ErrorHandler, metrics, Profiler  # <-- Importing Logger and ErrorHandler
 
 app = FastAPI()
 
 # Initialize the logger
 logger = Logger(name="main_module")
 
+# The ML checks can also be left to report workers on GPU nodes: set REPORT_ML_EXECUTION=queue here
+# and run python -m worker there (see worker.py). The workers then need the same RESPONSE_CACHE_REDIS_URL
+# as the API to invalidate its cached responses, without it the response cache is turned off
+
 """
 
 # ML PROCESSING HAS BEEN OUTSOURCED TO A LOCAL MACHINE WITH A NVIDIA GPU
@@ -41,16 +55,9 @@ async def startup():
 
 async def load_models():
     logger.log("Initializing machine learning models...", logging.INFO)
-    hf_token = os.getenv("HF_TOKEN")
-    try:
-        ML.Models.nlp = pipeline("document-question-answering", model="impira/layoutlm-document-qa",)
-        ML.Models.image_processor = AutoImageProcessor.from_pretrained("hustvl/yolos-tiny")
-        ML.Models.object_detection_model = AutoModelForObjectDetection.from_pretrained("hustvl/yolos-tiny")
-        ML.Models.speech_classifier = pipeline("zero-shot-classification", model="joeddav/xlm-roberta-large-xnli",token=hf_token)  # Initializing the new model at startup
-        logger.log("Machine learning models initialized successfully.", logging.INFO)
-    except Exception as e:
-        ErrorHandler.handle_exception(e)
-        logger.log(f"Error initializing models: {str(e)}", logging.ERROR)
+    # Models are loaded on first use by ML.Models. Loading them here only saves the wait of the first report
+    await run_in_threadpool(ML.Models.warm_up, None, False)
+    logger.log("Machine learning models initialized successfully.", logging.INFO)
 
 async def refresh_reports():
     try:
@@ -63,9 +70,9 @@ async def refresh_reports():
         reported_exam_names = set([data["test"] for data in all_reports_data])
         # Step 3: Check if new exams have been aded
         missing_reports = all_exam_names - reported_exam_names
-        # Step 4: Generate reports for those exams
-        for exam_name in missing_reports:
-            await produce_report(exam_name)
+        # Step 4: Generate reports for those exams, concurrently
+        failed = await report_scheduler.produce_reports(missing_reports)
+        for exam_name in missing_reports - set(failed):
             logger.log(f"Report generated and stored for exam: {exam_name}", logging.INFO)
 
     except Exception as e:
@@ -73,78 +80,321 @@ async def refresh_reports():
         logger.log(f"Error refreshing reports:
 """
 
-# Get The specific report for a specific test
+# Endpoints whose JSON responses are served from response_cache, by route template. Their cache entries
+# are keyed by exam and student, and dropped when a report refresh or incremental update writes to the exam
+CACHED_ROUTES = {
+    "/reports/{test_name}",
+    "/reports/{test_name}/summary",
+    "/reports/{test_name}/{student_email}",
+    "/reports/{test_name}/{student_email}/screenshot",
+    "/reports/{test_name}/{student_email}/out_of_frame",
+    "/reports/{test_name}/{student_email}/blur",
+    "/reports/{test_name}/{student_email}/object_detection",
+    "/reports/{test_name}/{student_email}/speech_detection",
+}
+# Response headers stored along with a cached body
+CACHED_HEADERS = ("x-next-cursor",)
+
+@app.on_event("startup")
+async def check_response_cache():
+    # Report workers write the queued check results from their own processes. Only a shared (Redis) store
+    # sees their invalidations, a per-process one would keep serving the pending results
+    if response_cache.enabled and report_utils.REPORT_ML_EXECUTION == "queue" and not response_cache.store.remote:
+        response_cache.enabled = False
+        logger.log("REPORT_ML_EXECUTION=queue without RESPONSE_CACHE_REDIS_URL, the response cache is turned off", logging.WARNING)
+
+async def cache_call(func, *args):
+    # The Redis store does network I/O, keep it off the event loop
+    if response_cache.store.remote:
+        return await run_in_threadpool(func, *args)
+    return func(*args)
+
+def match_route(scope: dict):
+    # The route a request will be handled by, with its path parameters
+    for route in app.router.routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route, child_scope
+    return None, {}
+
+def etagged_response(request: Request, body: bytes, media_type: str, headers: dict):
+    # The browser revalidates every time (no-cache) and gets a 304 when it already holds this body
+    headers = {**headers, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
+@app.middleware("http")
+async def cache_responses(request: Request, call_next):
+    # Streamed (ndjson) responses are never cached
+    if request.method != "GET" or not response_cache.enabled or request.query_params.get("format", "json") != "json":
+        return await call_next(request)
+    route, child_scope = match_route(request.scope)
+    if route is None or route.path not in CACHED_ROUTES:
+        return await call_next(request)
+    path_params = child_scope["path_params"]
+    # The key is resolved once: a response built while its exam is invalidated is stored under the old generation
+    cache_key = await cache_call(response_cache.key, route.path, path_params["test_name"],
+                                 path_params.get("student_email"), str(request.query_params))
+    cached = await cache_call(response_cache.get, cache_key)
+    if cached is not None:
+        metrics.increment("response_cache_requests_total", route=route.path, result="hit")
+        # Lets the latency metrics label a cache hit with its route
+        request.scope["route"] = route
+        return etagged_response(request, *cached)
+    metrics.increment("response_cache_requests_total", route=route.path, result="miss")
+    response = await call_next(request)
+    media_type = response.headers.get("content-type", "")
+    if response.status_code != 200 or not media_type.startswith("application/json"):
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+    headers["ETag"] = response_cache.etag(body)
+    await cache_call(response_cache.set, cache_key, body, media_type, headers)
+    return etagged_response(request, body, media_type, headers)
+
+# Latency of every request, per route template. With PROFILE_REQUESTS=true, a request sent with the
+# X-Profile header is also run under cProfile, and the X-Profile-File response header tells where the stats went
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() == "true"
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    profiler = Profiler(f"{request.method} {request.url.path}") if PROFILE_REQUESTS and request.headers.get("x-profile") else None
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        if profiler:
+            with profiler:
+                response = await call_next(request)
+        else:
+            response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        # The route template (e.g. /reports/{test_name}), so every exam does not get its own series
+        route = request.scope.get("route")
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - start, method=request.method,
+                        route=route.path if route else "unmatched", status=str(status_code))
+    if profiler and profiler.path:
+        response.headers["X-Profile-File"] = profiler.path
+    return response
+
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Models are loaded on demand. MODEL_WARMUP (comma-separated names, or "all") loads them in the background instead
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "")
+
+@app.on_event("startup")
+async def warm_up_models():
+    if not MODEL_WARMUP:
+        return
+    try:
+        ML.Models.warm_up(None if MODEL_WARMUP == "all" else [name.strip() for name in MODEL_WARMUP.split(",") if name.strip()])
+    except ErrorHandler.ModelError as e:
+        # A misspelled name warms up nothing, the models are still loaded on first use
+        ErrorHandler.handle_exception(e)
+        logger.log(f"Ignoring MODEL_WARMUP: {str(e)}", logging.ERROR)
+
+# Load time and resident size of each model
+@app.get("/models")
+async def get_model_stats():
+    return ML.Models.stats()
+
+# Create the indexes every endpoint query relies on, and move reports stored in the single-document
+# layout to one document per student. Safe to run on every launch
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await async_db.ensure_indexes()
+        logger.log("Database indexes are in place.", logging.INFO)
+    except Exception as e:
+        # Lists every collection whose indexes failed, the others are in place
+        ErrorHandler.handle_exception(e)
+        logger.log(f"Error creating database indexes: {str(e)}", logging.ERROR)
+    try:
+        migrated = await async_db.run(migrate_legacy_reports)
+        if migrated:
+            logger.log(f"Reports moved to one document per student for: {', '.join(migrated)}", logging.INFO)
+    except Exception as e:
+        ErrorHandler.handle_exception(e)
+        logger.log(f"Error migrating legacy reports: {str(e)}", logging.ERROR)
+
+# Student reports are stored one document per (test, student). These fields are only used for storage and filtering
+REPORT_PROJECTION = {"_id": 0, "test": 0, "failed": 0, "passed": 0}
+
+def student_reports_query(test_name: str, failed: str = None, after: str = None):
+    # Query for the student reports of an exam, optionally only those failing all the given (comma-separated)
+    # checks, starting right after the student of the given cursor (keyset pagination on student)
+    query = {"test": test_name}
+    if failed:
+        failed_checks = failed.split(",")
+        unknown_checks = set(failed_checks) - set(CHECK_ORDER)
+        if unknown_checks:
+            raise HTTPException(status_code=400, detail=f"Unknown checks: {', '.join(sorted(unknown_checks))}")
+        query["failed"] = {"$all": failed_checks}
+    if after:
+        try:
+            last_student = base64.urlsafe_b64decode(after.encode()).decode()
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+        query["student"] = {"$gt": last_student}
+    return query
+
+# Get The specific report for a specific test. With limit, the students are returned a page at a time
+# and X-Next-Cursor holds the cursor of the next page. failed filters on failed checks, e.g. failed=blur,speech
 @app.get("/reports/{test_name}")
-async def get_reports_for_test(test_name: str):
+async def get_reports_for_test(test_name: str, failed: str = None, after: str = None, limit: int = None):
     try:
-        # Step 1: Query the entry of the "reports" collection that corresponds to this test name
-        query = {"test": test_name}
-        report_data = db.get_mongo_collection("reports", query)
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        # Step 1: Query the student reports of this test name, in student order
+        query = student_reports_query(test_name, failed, after)
+        student_reports = await async_db.get_mongo_collection("reports", query, REPORT_PROJECTION, [("student", 1)], limit or 0)
 
-        # Step 2: Check if the report data exists for the given test name
-        if not report_data:
+        # Step 2: Check if the report exists for the given test name
+        if not student_reports and not (failed or after) and not await async_db.exists("reportSummaries", {"test": test_name}):
             raise HTTPException(status_code=404, detail=f"No reports found for test: {test_name}")
 
-        # Step 3: Return the 'reports' field of this entry
-        return report_data[0]["reports"]
+        # Step 3: Return the student reports
+        headers = None
+        if limit and len(student_reports) == limit:
+            headers = {"X-Next-Cursor": base64.urlsafe_b64encode(student_reports[-1]["student"].encode()).decode()}
+        return JSONResponse(student_reports, headers=headers)
 
+    except HTTPException:
+        raise
     except Exception as e:
         ErrorHandler.handle_exception(e)
         logger.log(f"Error fetching reports for test {test_name}: {str(e)}", logging.ERROR)
         raise HTTPException(status_code=500, detail=f"Error fetching reports for test: {test_name}")
 
-# Partial Refresh will be called from the Front-End on it's startup
-@app.get("/reports/refresh/partial")
-async def partial_refresh_reports():
+async def run_partial_refresh(on_start=None):
     try:
         logger.log("Initializing report refresh", logging.INFO)
         # Step 1: Query all exam names from the "test" collection
-        all_tests_data = db.get_mongo_collection("test")
-        all_exam_names = set([data["exam"] for data in all_tests_data])
-        # Step 2: Query existing reports from the database
-        all_reports_data = db.get_mongo_collection("reports")
-        reported_exam_names = set([data["test"] for data in all_reports_data])
+        all_exam_names = set(await load_exam_names(refresh=True))
+        # Step 2: Query existing reports from the database (every reported exam has a summary)
+        reported_exam_names = set(await async_db.get_distinct_values("reportSummaries", "test"))
         # Step 3: Check if new exams have been aded
         missing_reports = all_exam_names - reported_exam_names
-        # Step 4: Generate reports for those exams
-        for exam_name in missing_reports:
-            await produce_report(exam_name)
+        # Step 4: Generate reports for those exams, concurrently
+        failed = await report_scheduler.produce_reports(missing_reports, on_start=on_start)
+        for exam_name in missing_reports - set(failed):
             logger.log(f"Report generated and stored for exam: {exam_name}", logging.INFO)
+        return missing_reports, failed
+    finally:
+        exam_names_cache.invalidate()
 
-    except Exception as e:
-        ErrorHandler.handle_exception(e)
-        logger.log(f"Error refreshing reports: {str(e)}", logging.ERROR)
+async def run_full_refresh(on_start=None):
+    try:
+        # Step 1: Start from empty staging collections. The live reports stay readable during the rebuild
+        await async_db.clear_mongo_collection("reportsStaging")
+        await async_db.clear_mongo_collection("reportSummariesStaging")
+        report_scheduler.clear_staged()
+        # Step 2: Query all exam names from the test collection
+        exam_names = await load_exam_names(refresh=True)
+        # Step 3: Produce the report of every exam into the staging collection, concurrently
+        failed = await report_scheduler.produce_reports(exam_names, "reportsStaging", on_start)
+        if failed:
+            logger.log(f"Reports could not be produced for: {', '.join(failed)}. Keeping the current reports.", logging.ERROR)
+            return exam_names, failed
+        # Step 4: Swap the rebuilt reports in atomically, then their summaries
+        await async_db.replace_collection("reports", "reportsStaging")
+        await async_db.replace_collection("reportSummaries", "reportSummariesStaging")
+        await cache_call(response_cache.invalidate)
+        await report_scheduler.commit_staged()
+        logger.log("Reports fully refreshed.", logging.INFO)
+        return exam_names, failed
+    finally:
+        exam_names_cache.invalidate()
+
+async def submit_refresh_job(kind: str, refresh, background_tasks: BackgroundTasks):
+    # Queue a refresh job to run after the response is sent, unless the same refresh is already pending
+    job, created = refresh_jobs.submit(kind)
+    if created:
+        background_tasks.add_task(refresh_jobs.run, job["job_id"], refresh)
+    return {"job_id": job["job_id"], "status": job["status"], "deduplicated": not created}
+
+# Partial Refresh will be called from the Front-End on it's startup
+@app.get("/reports/refresh/partial")
+async def partial_refresh_reports(background_tasks: BackgroundTasks):
+    return await submit_refresh_job("partial", run_partial_refresh, background_tasks)
 
 # Full Refresh to be used if ever needed
 @app.get("/reports/refresh/full")
-async def full_refresh_reports():
-    try:
-        # Step 1: Delete all elements from the reports collection
-        db.clear_mongo_collection("reports")
-        logger.log("Cleared all reports from the database.", logging.INFO)
-        # Step 2: Query all exam names from the test collection
-        test_data = db.get_mongo_collection("test")
-        exam_names = set([data["exam"] for data in test_data])
-        # Step 3: Call produce_report for each exam name
-        for exam_name in exam_names:
-            await produce_report(exam_name)
-            logger.log(f"Refreshed report for test: {exam_name}", logging.INFO)
-        return {"status": "success", "message": "Reports fully refreshed."}
+async def full_refresh_reports(background_tasks: BackgroundTasks):
+    return await submit_refresh_job("full", run_full_refresh, background_tasks)
 
-    except Exception as e:
-        ErrorHandler.handle_exception(e)
-        logger.log(f"Error during full refresh: {str(e)}", logging.ERROR)
-        raise HTTPException(status_code=500, detail="Error during full refresh of reports.")
+# Incremental Refresh re-runs only the checks whose data changed since the reports were built
+@app.get("/reports/refresh/incremental")
+async def incremental_refresh_reports(background_tasks: BackgroundTasks):
+    return await submit_refresh_job("incremental", report_scheduler.update_changed_reports, background_tasks)
+
+# Optionally poll for new proctoring events and update the reports in the background
+INCREMENTAL_REFRESH_INTERVAL_SECONDS = float(os.getenv("INCREMENTAL_REFRESH_INTERVAL_SECONDS", "0"))
+background_loops = set()
+
+@app.on_event("startup")
+async def start_incremental_refresh():
+    if INCREMENTAL_REFRESH_INTERVAL_SECONDS > 0:
+        task = asyncio.create_task(poll_incremental_refresh())
+        background_loops.add(task)
+        task.add_done_callback(background_loops.discard)
+
+async def poll_incremental_refresh():
+    while True:
+        await asyncio.sleep(INCREMENTAL_REFRESH_INTERVAL_SECONDS)
+        job, created = refresh_jobs.submit("incremental")
+        if created:
+            await refresh_jobs.run(job["job_id"], report_scheduler.update_changed_reports)
+
+# Status of a refresh job, with the progress of each of its exams
+@app.get("/reports/refresh/jobs/{job_id}")
+async def get_refresh_job(job_id: str):
+    job = refresh_jobs.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No refresh job with id: {job_id}")
+    return {**job, "progress": {exam: report_scheduler.progress.get(exam) for exam in job["exams"]}}
+
+# Progress of the report generation, per exam
+@app.get("/reports/refresh/progress")
+async def get_refresh_progress():
+    return report_scheduler.progress
+
+# Pass/fail counts per check for an exam. Declared after the refresh routes, which share the path shape
+@app.get("/reports/{test_name}/summary")
+async def get_report_summary(test_name: str):
+    summaries = await async_db.get_mongo_collection("reportSummaries", {"test": test_name}, {"_id": 0}, limit=1)
+    if not summaries:
+        raise HTTPException(status_code=404, detail=f"No reports found for test: {test_name}")
+    return summaries[0]
+
+# The report of a single student
+@app.get("/reports/{test_name}/{student_email}")
+async def get_student_report(test_name: str, student_email: str):
+    student_reports = await async_db.get_mongo_collection("reports", {"test": test_name, "student": student_email},
+                                                          REPORT_PROJECTION, limit=1)
+    if not student_reports:
+        raise HTTPException(status_code=404, detail=f"No report found for student {student_email} in test: {test_name}")
+    return student_reports[0]
+
+async def load_exam_names(refresh: bool = False):
+    # Distinct exam names from the test collection, cached for EXAMS_CACHE_TTL_SECONDS.
+    # refresh=True skips the cache, e.g. when a report refresh needs the current list
+    exam_names = None if refresh else exam_names_cache.get("exams")
+    if exam_names is None:
+        exam_names = await async_db.get_distinct_values("test", "exam")
+        exam_names_cache.set("exams", exam_names)
+    return exam_names
 
 # Get exams. To be used by the Front-End to list the available examinations    
 @app.get("/exams")
 async def get_exam_names():
     try:
-        # Step 1: Query all exam names from the test collection
-        test_data = db.get_mongo_collection("test")
-        exam_names = set([data["exam"] for data in test_data])
-        # Step 3: Call produce_report for each exam name
-        return exam_names
+        # Step 1: Query all exam names from the test collection (served from the cache when fresh)
+        return await load_exam_names()
 
     except Exception as e:
         ErrorHandler.handle_exception(e)
@@ -159,158 +409,198 @@ async def get_screenshot_details(test_name: str, student_email: str):
         # Constructing the query to find the document that matches the given test_name and student_email
         query = {"exam": test_name, "student": student_email}
         # Retrieving the entry from the screenshot collection in the database
-        screenshot_entries = db.get_mongo_collection("screenshot", query)        
+        screenshot_entries = await async_db.get_mongo_collection("screenshot", query, {"_id": 1}, limit=1)
         # If there are no entries that match the query, return the status message
         if not screenshot_entries:
             return "The student sent no screenshot"
-        # Assuming there is only one entry that matches the query, return the image field of the entry
-        return screenshot_entries[0]["image"]
+        # Assuming there is only one entry that matches the query, return the URL of its image
+        return image_url("screenshot", screenshot_entries[0])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+def sort_photos_by_time(photo_entries: list):
+    # Parse each photo timestamp once and return the (sorted) timestamps with their image URLs, in matching order
+    timed_photos = sorted(
+        ((parser.parse(photo_entry.get("time")), image_url("periodicPhotos", photo_entry)) for photo_entry in photo_entries),
+        key=lambda timed_photo: timed_photo[0]
+    )
+    photo_times = [photo_time for photo_time, _ in timed_photos]
+    photo_images = [image for _, image in timed_photos]
+    return photo_times, photo_images
+
+# Per-student event lists are read in time order (db.TIME_ORDER), _id breaks ties between events with the same time
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(entry: dict):
+    # Opaque pagination cursor holding the (time, _id) of the last entry of a page
+    return base64.urlsafe_b64encode(json.dumps([entry["time"], entry["_id"]]).encode()).decode()
+
+def student_events_query(test_name: str, student_email: str, after: str = None):
+    # Query for a student's events in an exam, starting right after the given cursor (keyset pagination)
+    query = {"exam": test_name, "student": student_email}
+    if after:
+        try:
+            # json_util restores the ObjectId/datetime values encoded in the cursor
+            last_time, last_id = json_util.loads(base64.urlsafe_b64decode(after.encode()))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+        query["$or"] = [{"time": {"$gt": last_time}}, {"time": last_time, "_id": {"$gt": last_id}}]
+    return query
+
+def each_entry(to_item):
+    # Turn a function building the item of one entry into the batch function of student_events_response
+    async def to_items(entries: list):
+        return [to_item(entry) for entry in entries]
+    return to_items
+
+async def student_events_response(collection_name: str, query: dict, projection: dict, to_items,
+                                  limit: int = None, format: str = "json"):
+    # Build the response of a per-student event list. to_items is a coroutine function turning a batch of entries
+    # into response items. format="ndjson" streams one JSON object per line, pulling the cursor in batches so
+    # memory stays flat. Otherwise a JSON array is returned. When limit is set, X-Next-Cursor holds the cursor of the next page
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    # The cursor needs time and _id, whatever the endpoint returns
+    projection = {**projection, "time": 1, "_id": 1}
+    if format == "ndjson":
+        async def lines():
+            async for batch in async_db.iterate_batches(collection_name, query, projection, db.TIME_ORDER, limit or 0):
+                yield "".join(json.dumps(item) + "\n" for item in await to_items(batch))
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    entries = await async_db.get_mongo_collection(collection_name, query, projection, db.TIME_ORDER, limit or 0)
+    headers = {"X-Next-Cursor": encode_cursor(entries[-1])} if limit and len(entries) == limit else None
+    return JSONResponse(await to_items(entries), headers=headers)
+
+# Stored times in UTC: "Z" or a zero offset
+UTC_TIME = re.compile(r"(Z|[+-]00:?00)$")
+
+def time_bound(moment: datetime, seconds: int):
+    # UTC timestamp prefix, moved by the given seconds, to compare against the stored UTC time strings.
+    # Moving it a second out keeps the range inclusive whatever the stored precision and suffix
+    return (moment.replace(tzinfo=None) + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S")
+
+async def photos_between(test_name: str, student_email: str, start: datetime, end: datetime):
+    # Sorted times and image URLs of the student's periodic photos taken from start to end (both included).
+    # Times are strings, so a range on them only holds for UTC ones: for UTC events the range is read with the
+    # (exam, student, time) index, along with any photo stored with another offset. Events with another offset
+    # are matched against all of the student's photos. The exact ends are applied on the parsed times
+    query = {"exam": test_name, "student": student_email}
+    if start.utcoffset() == timedelta(0) and end.utcoffset() == timedelta(0):
+        query["$or"] = [{"time": {"$gte": time_bound(start, -1), "$lt": time_bound(end, 1)}},
+                        {"time": {"$not": UTC_TIME}}]
+    photo_entries = await async_db.get_mongo_collection("periodicPhotos", query, {"time": 1})
+    photo_times, photo_images = sort_photos_by_time(photo_entries)
+    first = bisect_left(photo_times, start)
+    last = bisect_right(photo_times, end)
+    return photo_times[first:last], photo_images[first:last]
+
 # Get a specific out of frame report
 @app.get("/reports/{test_name}/{student_email}/out_of_frame")
-async def get_out_of_frame_details(test_name: str, student_email: str):
+async def get_out_of_frame_details(test_name: str, student_email: str, after: str = None, limit: int = None, format: str = "json"):
     try:
-        out_of_frame_entries = db.get_mongo_collection("outOfFrame", {"exam": test_name, "student": student_email})
-        final_data = []
-        
-        # Retrieving all corresponding images from the periodicPhotos collection in the database for the given test_name and student_email
-        all_periodic_photos_entries = db.get_mongo_collection("periodicPhotos", {"exam": test_name, "student": student_email})
-        
-        for entry in out_of_frame_entries:
-            time_str = entry.get("time")
-            duration = entry.get("duration")
-            time_dt = parser.parse(time_str)
-            end_time_dt = time_dt + timedelta(seconds=duration)
-            
-            # Filtering the periodic_photos_entries based on the time frame
-            filtered_periodic_photos_entries = [
-                photo_entry for photo_entry in all_periodic_photos_entries
-                if time_dt <= parser.parse(photo_entry.get("time")) <= end_time_dt
-            ]
-            
-            # Extracting the base64 images from the filtered entries
-            images_base64 = [photo_entry.get("image") for photo_entry in filtered_periodic_photos_entries]
-            
-            final_data.append({
-                "time": time_str,
-                "duration": duration,
-                "images": images_base64
-            })
-        
-        return final_data
+        query = student_events_query(test_name, student_email, after)
+
+        async def out_of_frame_items(entries):
+            # No outOfFrame events on this page (or batch), no photos to fetch
+            if not entries:
+                return []
+            windows = [(parser.parse(entry.get("time")), entry.get("duration")) for entry in entries]
+            windows = [(time_dt, time_dt + timedelta(seconds=duration)) for time_dt, duration in windows]
+            # Only the photos of the time range these events cover, parsed once and sorted,
+            # so each time frame is found with a binary search
+            photo_times, photo_images = await photos_between(test_name, student_email,
+                                                             min(start for start, _ in windows), max(end for _, end in windows))
+            items = []
+            for entry, (time_dt, end_time_dt) in zip(entries, windows):
+                # Finding the photos taken within the time frame (both ends included)
+                first = bisect_left(photo_times, time_dt)
+                last = bisect_right(photo_times, end_time_dt)
+                items.append({
+                    "time": entry.get("time"),
+                    "duration": entry.get("duration"),
+                    "images": photo_images[first:last]
+                })
+            return items
+
+        return await student_events_response("outOfFrame", query, {"duration": 1}, out_of_frame_items, limit, format)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Get a specific blur report
 @app.get("/reports/{test_name}/{student_email}/blur")
-async def get_blur_details(test_name: str, student_email: str):
+async def get_blur_details(test_name: str, student_email: str, after: str = None, limit: int = None, format: str = "json"):
     try:
         # Constructing the query to find the documents that match the given test_name and student_email in blur collection
-        query = {
-            "student": student_email,
-            "exam": test_name
-        }
+        query = student_events_query(test_name, student_email, after)
         logger.log(f"Connecting to blur database for student: {student_email}", logging.INFO)
-        # Retrieving the corresponding entries from the blur collection in the database
-        blur_entries = db.get_mongo_collection("blur", query)
-        logger.log(f"Retrieving blur entries: {blur_entries}", logging.INFO)
-        # Extracting the time and message from each entry and returning them
-        return [{"time": entry["time"], "msg": entry["msg"]} for entry in blur_entries]
-        
+        # Extracting the time and message from each entry of the blur collection and returning them
+        return await student_events_response("blur", query, {"msg": 1},
+                                              each_entry(lambda entry: {"time": entry["time"], "msg": entry["msg"]}), limit, format)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Get a specific object detection report
 @app.get("/reports/{test_name}/{student_email}/object_detection")
-async def get_object_detection_details(test_name: str, student_email: str):
+async def get_object_detection_details(test_name: str, student_email: str, after: str = None, limit: int = None, format: str = "json"):
     try:
-        # Constructing the query to find the documents that match the given test_name and student_email in blur collection
-        query = {
-            "student": student_email,
-            "exam": test_name
-        }
+        # Constructing the query to find the documents that match the given test_name and student_email in ObjectDetectionData collection
+        query = student_events_query(test_name, student_email, after)
         logger.log(f"Connecting to periodicPhotos database for student: {student_email}", logging.INFO)
-        # Retrieving the corresponding entries from the blur collection in the database
-        photo_entries = db.get_mongo_collection("ObjectDetectionData", query)
-        # Extracting the time and message from each entry and returning them
-        return [{"time": entry["time"], "image": entry["image"]} for entry in photo_entries]
+        # Extracting the time and image URL from each entry and returning them
+        return await student_events_response("ObjectDetectionData", query, {},
+                                              each_entry(lambda entry: {"time": entry["time"], "image": image_url("ObjectDetectionData", entry)}), limit, format)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Get a specific speech detection report
 @app.get("/reports/{test_name}/{student_email}/speech_detection")
-async def get_speech_detection_details(test_name: str, student_email: str):
+async def get_speech_detection_details(test_name: str, student_email: str, after: str = None, limit: int = None, format: str = "json"):
     try:
-        # Constructing the query to find the documents that match the given test_name and student_email in blur collection
-        query = {
-            "student": student_email,
-            "exam": test_name
-        }
+        # Constructing the query to find the documents that match the given test_name and student_email in conversations collection
+        query = student_events_query(test_name, student_email, after)
         logger.log(f"Connecting to speech database for student: {student_email}", logging.INFO)
-        # Retrieving the corresponding entries from the blur collection in the database
-        speech_entries = db.get_mongo_collection("conversations", query)
-        # Extracting the time and message from each entry and returning them
-        return [{"time": entry["time"], "conversation": entry["conversation"]} for entry in speech_entries]
+        # Extracting the time and conversation from each entry and returning them
+        return await student_events_response("conversations", query, {"conversation": 1},
+                                             each_entry(lambda entry: {"time": entry["time"], "conversation": entry["conversation"]}), limit, format)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-"""
-def retrieve_students(exam_name: str):
+def image_url(collection_name: str, entry: dict):
+    # URL of the image endpoint serving the image of a document fetched with its _id
+    return app.url_path_for("get_image", collection_name=collection_name, image_id=entry["_id"]["$oid"])
+
+# Get a single image as raw bytes. Images never change once stored, so they can be cached for good
+@app.get("/images/{collection_name}/{image_id}")
+async def get_image(collection_name: str, image_id: str, request: Request, thumbnail: bool = False):
+    if collection_name not in image_utils.IMAGE_COLLECTIONS or not ObjectId.is_valid(image_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+    etag = f'"{image_id}-thumbnail"' if thumbnail else f'"{image_id}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    # The browser already holds this exact image
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
     try:
-        logger.log(f"Fetching the list of students for the test: {exam_name}", logging.INFO)
-        students_data = db.get_mongo_collection("test")
-        students_list = list(set([data["student"] for data in students_data if data["exam"].lower() == exam_name.lower()]))
-        logger.log(f"Students list: {students_list}", logging.INFO)
-        return students_list
+        entries = await async_db.get_mongo_collection(collection_name, {"_id": ObjectId(image_id)}, {"image": 1, "_id": 0}, limit=1)
+        if not entries or not entries[0].get("image"):
+            raise HTTPException(status_code=404, detail="Image not found")
+        # Decode the data URL once and send the raw bytes
+        media_type, image_bytes = image_utils.split_data_url(entries[0]["image"])
+        if thumbnail:
+            image_bytes = await run_in_threadpool(image_utils.make_thumbnail, image_bytes)
+            media_type = "image/jpeg"
+        headers["Content-Length"] = str(len(image_bytes))
+        return StreamingResponse(image_utils.iter_chunks(image_bytes), media_type=media_type, headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
-        ErrorHandler.handle_exception(e)
-        logger.log(str(e), logging.ERROR)
-        return []
-
-# Produce full report for a given exam
-async def produce_report(test_name: str):
-    logger.log(f"Generating reports for test: {test_name}", logging.INFO)    
-    # Step 1: Retrieve the list of students who took the test
-    students_list = retrieve_students(test_name)    
-    logger.log(f"List of students who took the specified test: {students_list}", logging.INFO)
-    # Step 2: Initialize an empty list to hold the reports for each student
-    student_reports = [] 
-    # Step 3: Generate report for each student for thist est   
-    for student_email in students_list:
-        # Generate the report for the student
-        report = get_student_report(student_email,test_name)
-        # Append the report to the list of reports
-        student_reports.append(report)    
-    # Step 4: Create the final report structure
-    final_report = {
-        "test": test_name,
-        "reports": student_reports
-    }
-    # Step 5: Store the final report in the database
-    db.insert_into_mongo_collection("reports",final_report)
-    logger.log(f"Reports generated successfully for test: {test_name}", logging.INFO)
-
-
-def get_student_report(student_email: str,student_test : str):
-    logger.log(f"Generating report for student: {student_email}", logging.INFO)
-    # Initialize an empty dictionary that will hold the report for the student
-    student_report = dict()
-    student_report["student"] = student_email
-    try:
-        # Process student screenshot and append results to the report
-        ML.get_screenshot_report(student_email,student_test,student_report)
-        ML.get_OOF_report(student_email,student_test,student_report) 
-        ML.get_blur_report(student_email,student_test,student_report) 
-        ML.get_OD_report(student_email,student_test,student_report)
-        ML.get_speech_report(student_email,student_test,student_report)
-        # ... other report functions will go here ...
-    except ErrorHandler.Error as e:
-        ErrorHandler.handle_exception(e)
-        logger.log(str(e), logging.ERROR)
-    
-    logger.log(f"Report generated successfully for student: {student_email}", logging.INFO)
-    return student_report
-"""
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
@@ -1,21 +1,245 @@
-from PIL import Image
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import torch 
-import base64
-from transformers import pipeline
+import logging
+import os
+import gc
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 import db
-from project_utils import Logger, ErrorHandler  # Import the Logger and ErrorHandler
+import image_utils
+from cache_utils import inference_cache
+from project_utils import Logger, ErrorHandler, metrics  # Import the Logger and ErrorHandler
 
 # Initialize the logger for this module
 logger = Logger(__name__)
 
-"""
-# Wrapper for ML models. The attributes are initialized at startup. 
-class Models:
-    nlp = None
-    image_processor = None
-    object_detection_model = None
-    speech_classifier = None
+# ML processing runs outside the API (see main.py). Nothing here loads a model at import time
+
+# Object detection settings
+OD_BATCH_SIZE = int(os.getenv("OD_BATCH_SIZE", "8"))
+OD_DECODE_WORKERS = int(os.getenv("OD_DECODE_WORKERS", "4"))
+OD_THRESHOLD = 0.5
+CELL_PHONE_CONFIDENCE = 0.9
+# Detections are written to ObjectDetectionData in bulk, this many at a time
+OD_WRITE_BATCH_SIZE = int(os.getenv("OD_WRITE_BATCH_SIZE", "100"))
+
+# Change detection before object detection. A frame less than OD_CHANGE_THRESHOLD bits (out of 64) away from
+# the last analysed frame is skipped, but at least every OD_MIN_SAMPLE_EVERY-th frame is analysed.
+# OD_CHANGE_THRESHOLD=0 analyses every frame
+OD_CHANGE_THRESHOLD = int(os.getenv("OD_CHANGE_THRESHOLD", "5"))
+OD_MIN_SAMPLE_EVERY = int(os.getenv("OD_MIN_SAMPLE_EVERY", "10"))
+
+# Speech classification settings. SPEECH_BATCH_SIZE snippets (times the number of themes) go through the model at once
+SPEECH_BATCH_SIZE = int(os.getenv("SPEECH_BATCH_SIZE", "16"))
+SPEECH_MAX_LENGTH = int(os.getenv("SPEECH_MAX_LENGTH", "512"))
+SPEECH_THRESHOLD = 0.5
+# Same hypothesis as the zero-shot-classification pipeline default
+SPEECH_HYPOTHESIS_TEMPLATE = "This example is {}."
+
+# Model checkpoints. With INFERENCE_CACHE_VERSION they make up the model part of the inference cache keys.
+# Bump the version whenever the way a model output is produced or post-processed changes
+MODEL_CHECKPOINTS = {
+    "nlp": "impira/layoutlm-document-qa",
+    "object_detection_model": "hustvl/yolos-tiny",
+    "speech_classifier": "joeddav/xlm-roberta-large-xnli",
+}
+INFERENCE_CACHE_VERSION = os.getenv("INFERENCE_CACHE_VERSION", "2")
+SCREENSHOT_QUESTION = "What does the title say?"
+
+# Inference backend of the models that support more than one:
+# "torch" runs the float model as loaded, "quantized" runs it with int8 dynamically quantized Linear layers (CPU only)
+INFERENCE_BACKENDS = ("torch", "quantized")
+MODEL_BACKENDS = {
+    "object_detection_model": os.getenv("OD_BACKEND", "torch"),
+    "speech_classifier": os.getenv("SPEECH_BACKEND", "torch"),
+}
+
+def cache_model_key(model_name: str, *settings):
+    # Model part of an inference cache key, including any setting that changes the cached output
+    backend = MODEL_BACKENDS.get(model_name, "torch")
+    if backend != "torch":
+        settings = (*settings, backend)
+    return "@".join([MODEL_CHECKPOINTS[model_name], INFERENCE_CACHE_VERSION, *map(str, settings)])
+
+def quantize(model):
+    # Linear layers hold nearly all the weights and compute of YOLOS and XLM-R, quantize them to int8
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def with_backend(model_name: str, model, backend: str = None):
+    # Return the model (or pipeline) prepared for its configured inference backend
+    backend = backend or MODEL_BACKENDS.get(model_name, "torch")
+    if backend not in INFERENCE_BACKENDS:
+        raise ErrorHandler.ModelError(f"Unknown inference backend for {model_name}: {backend}")
+    if backend == "quantized":
+        if isinstance(model, torch.nn.Module):
+            return quantize(model.to("cpu")).eval()
+        # A pipeline: quantize the model it wraps
+        model.model = quantize(model.model.to("cpu")).eval()
+        model.device = torch.device("cpu")
+    return model
+
+# Loaders of the models used by the reports. transformers is imported lazily, the API never needs it
+def _load_nlp():
+    from transformers import pipeline
+    return pipeline("document-question-answering", model=MODEL_CHECKPOINTS["nlp"])
+
+def _load_image_processor():
+    from transformers import AutoImageProcessor
+    return AutoImageProcessor.from_pretrained(MODEL_CHECKPOINTS["object_detection_model"])
+
+def _load_object_detection_model():
+    from transformers import AutoModelForObjectDetection
+    model = AutoModelForObjectDetection.from_pretrained(MODEL_CHECKPOINTS["object_detection_model"]).eval()
+    return with_backend("object_detection_model", model)
+
+def _load_speech_classifier():
+    from transformers import pipeline
+    classifier = pipeline("zero-shot-classification", model=MODEL_CHECKPOINTS["speech_classifier"], token=os.getenv("HF_TOKEN"))
+    return with_backend("speech_classifier", classifier)
+
+def resident_size(model):
+    # Bytes held by the parameters and buffers of a torch model (or of the model inside a pipeline)
+    module = getattr(model, "model", model)
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    # The state dict also covers the packed int8 weights of quantized layers, which are not parameters
+    def tensors(values):
+        for value in values:
+            if isinstance(value, torch.Tensor):
+                yield value
+            elif isinstance(value, (tuple, list)):
+                yield from tensors(value)
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors(module.state_dict().values()))
+
+class ModelRegistry:
+    """Loads each model on first use, behind a per-model lock, and keeps the loaded models within
+    a memory budget by unloading the least recently used ones.
+    Models are reached as attributes (Models.speech_classifier), so callers never load them explicitly."""
+
+    def __init__(self, loaders: dict, memory_budget_mb: float = 0):
+        object.__setattr__(self, "_loaders", dict(loaders))
+        object.__setattr__(self, "_memory_budget", memory_budget_mb * 2**20)
+        # name -> model, in least to most recently used order
+        object.__setattr__(self, "_models", OrderedDict())
+        object.__setattr__(self, "_stats", {name: {"loaded": False, "load_seconds": None, "resident_mb": 0, "loads": 0}
+                                            for name in loaders})
+        object.__setattr__(self, "_locks", {name: threading.Lock() for name in loaders})
+        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_unload_callbacks", [])
+
+    def on_unload(self, callback):
+        """Call callback(name) whenever a loaded model is unloaded or replaced, to drop what refers to it."""
+        self._unload_callbacks.append(callback)
+
+    def __getattr__(self, name: str):
+        if name not in self._loaders:
+            raise AttributeError(name)
+        return self.get(name)
+
+    def __setattr__(self, name: str, model):
+        # Assigning a model (e.g. Models.nlp = ...) registers it as loaded
+        if name not in self._loaders:
+            raise AttributeError(name)
+        with self._lock:
+            if self._models.get(name, model) is not model:
+                for callback in self._unload_callbacks:
+                    callback(name)
+            self._models[name] = model
+            self._stats[name].update(loaded=True, resident_mb=round(resident_size(model) / 2**20, 1))
+
+    def get(self, name: str):
+        """Return the model, loading it on first use."""
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+        with self._locks[name]:
+            # Another thread may have loaded it while we waited for the lock
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name]
+            logger.log(f"Loading model: {name}", logging.INFO)
+            start = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                raise ErrorHandler.ModelError(f"Error loading model {name}: {str(e)}")
+            load_seconds = time.perf_counter() - start
+            with self._lock:
+                self._models[name] = model
+                self._stats[name].update(loaded=True, load_seconds=round(load_seconds, 2),
+                                         resident_mb=round(resident_size(model) / 2**20, 1))
+                self._stats[name]["loads"] += 1
+                self._enforce_budget(keep=name)
+            logger.log(f"Model {name} loaded in {load_seconds:.1f}s ({self._stats[name]['resident_mb']} MB)", logging.INFO)
+            return model
+
+    def unload(self, name: str):
+        """Drop a loaded model so its memory can be reclaimed."""
+        with self._lock:
+            self._unload(name)
+
+    def _unload(self, name: str):
+        if self._models.pop(name, None) is None:
+            return
+        self._stats[name]["loaded"] = False
+        for callback in self._unload_callbacks:
+            callback(name)
+        logger.log(f"Unloaded model: {name}", logging.INFO)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _enforce_budget(self, keep: str):
+        # Unload least recently used models until the loaded ones fit in the budget. 0 means no budget
+        if not self._memory_budget:
+            return
+        for name in list(self._models):
+            if sum(self._stats[loaded]["resident_mb"] for loaded in self._models) * 2**20 <= self._memory_budget:
+                return
+            if name != keep:
+                self._unload(name)
+
+    def warm_up(self, names: list = None, background: bool = True):
+        """Load the given models (all by default) ahead of their first use, optionally in a background thread."""
+        names = list(names or self._loaders)
+        unknown = [name for name in names if name not in self._loaders]
+        if unknown:
+            raise ErrorHandler.ModelError(f"Unknown models: {', '.join(unknown)}. Known models: {', '.join(self._loaders)}")
+
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except ErrorHandler.Error as e:
+                    ErrorHandler.handle_exception(e)
+                    logger.log(str(e), logging.ERROR)
+
+        if not background:
+            return load_all()
+        thread = threading.Thread(target=load_all, name="model-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Load time and resident size of every model."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+# Registry of the ML models. Nothing is loaded until a report needs it
+Models = ModelRegistry(
+    {
+        "nlp": _load_nlp,
+        "image_processor": _load_image_processor,
+        "object_detection_model": _load_object_detection_model,
+        "speech_classifier": _load_speech_classifier,
+    },
+    memory_budget_mb=float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+)
 
 def get_screenshot_report(student_email: str, student_test: str, student_report: dict):
     logger.log(f"Generating screenshot report for student: {student_email} for the test: {student_test}")
@@ -26,13 +250,21 @@ def get_screenshot_report(student_email: str, student_test: str, student_report:
     # Only keep the latest screenshot
     screenshot_data = screenshots[-1]
     base64_image = screenshot_data["image"]
-    # Convert base64 to JPG
-    image_data = base64.b64decode(base64_image.split(',')[1])
-    image = Image.open(BytesIO(image_data))
-    image = image.convert('RGB')
+    # The same screenshot was already read by this model
+    model_key = cache_model_key("nlp")
+    content_hash = inference_cache.content_hash(base64_image, SCREENSHOT_QUESTION)
+    title_data = inference_cache.get(model_key, content_hash)
+    if title_data is None:
+        # Convert base64 to JPG
+        image = image_utils.decode_data_url(base64_image)
     try:
-        # Use the document-question-answering pipeline
-        title_data = Models.nlp(image, "What does the title say?")[0]
+        if title_data is None:
+            # Use the document-question-answering pipeline
+            record_inference("nlp", 1)
+            with metrics.timer("model_inference_duration_seconds", model="nlp"):
+                answer_data = Models.nlp(image, SCREENSHOT_QUESTION)[0]
+            title_data = {"score": float(answer_data.get('score', 0)), "answer": str(answer_data.get('answer', ''))}
+            inference_cache.put(model_key, content_hash, title_data)
         score = title_data.get('score', 0)
         answer = title_data.get('answer', '').lower()
         if score < 0.5:
@@ -47,12 +279,15 @@ def get_screenshot_report(student_email: str, student_test: str, student_report:
 
 
 
-def get_OOF_report(student_email: str, student_test: str, student_report: dict):
+# The presence checks accept present=True/False when it is already known (see db.get_presence_flags)
+
+def get_OOF_report(student_email: str, student_test: str, student_report: dict, present: bool = None):
     logger.log(f"Generating out of frame report for student: {student_email} for the test: {student_test}")
     try:
-        # Query the outOfFrame collection for documents with the student's email and test
-        out_of_frame_data = db.get_mongo_collection("outOfFrame", {"student": student_email, "exam": student_test})
-        if out_of_frame_data:
+        # Check whether the outOfFrame collection has any document with the student's email and test
+        if present is None:
+            present = db.exists("outOfFrame", {"student": student_email, "exam": student_test})
+        if present:
             student_report["outOfFrame"] = "FAIL"
             logger.log(f"Student {student_email} has failed the out of frame test for {student_test}.")
         else:
@@ -62,12 +297,13 @@ def get_OOF_report(student_email: str, student_test: str, student_report: dict):
         ErrorHandler.handle_exception(e)
         logger.log(str(e), logging.ERROR)
 
-def get_blur_report(student_email: str, student_test: str, student_report: dict):
+def get_blur_report(student_email: str, student_test: str, student_report: dict, present: bool = None):
     logger.log(f"Generating blur report for student: {student_email} for the test: {student_test}")
     try:
-        # Query the blur collection for documents with the student's email and test
-        blur_data = db.get_mongo_collection("blur", {"student": student_email, "exam": student_test})
-        if blur_data:
+        # Check whether the blur collection has any document with the student's email and test
+        if present is None:
+            present = db.exists("blur", {"student": student_email, "exam": student_test})
+        if present:
             student_report["blur"] = "FAIL"
         else:
             student_report["blur"] = "SUCCESS"
@@ -75,67 +311,236 @@ def get_blur_report(student_email: str, student_test: str, student_report: dict)
         ErrorHandler.handle_exception(e)
         logger.log(str(e), logging.ERROR)
 
+def record_inference(model_name: str, items: int):
+    # Count a batch of items run through a model, for the /metrics endpoint
+    metrics.increment("model_inference_batches_total", model=model_name)
+    metrics.increment("model_inference_items_total", items, model=model_name)
+
+def detect_objects(images: list, image_processor, model, threshold: float = OD_THRESHOLD):
+    # Run a whole batch through the detector and return, per image, the list of (label, score) detections
+    record_inference("object_detection_model", len(images))
+    with metrics.timer("model_inference_duration_seconds", model="object_detection_model"), torch.inference_mode():
+        inputs = image_processor(images=images, return_tensors="pt")
+        outputs = model(**inputs)
+        # Convert outputs to COCO API
+        target_sizes = torch.tensor([image.size[::-1] for image in images])
+        results = image_processor.post_process_object_detection(outputs, threshold=threshold, target_sizes=target_sizes)
+    return [
+        [(model.config.id2label[label.item()], score.item()) for score, label in zip(result["scores"], result["labels"])]
+        for result in results
+    ]
+
+class FrameSampler:
+    """Decides, frame by frame in time order, whether a frame changed enough to be analysed."""
+
+    def __init__(self, change_threshold: int = OD_CHANGE_THRESHOLD, min_sample_every: int = OD_MIN_SAMPLE_EVERY):
+        self.change_threshold = change_threshold
+        self.min_sample_every = max(min_sample_every, 1)
+        self.last_signature = None
+        self.since_analysed = 0
+        self.analysed = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return self.change_threshold > 0 and self.min_sample_every > 1
+
+    def keep(self, signature: int):
+        if (self.last_signature is None or self.since_analysed + 1 >= self.min_sample_every
+                or image_utils.signature_distance(signature, self.last_signature) >= self.change_threshold):
+            self.last_signature = signature
+            self.since_analysed = 0
+            self.analysed += 1
+            return True
+        self.since_analysed += 1
+        self.skipped += 1
+        return False
+
+    def stats(self):
+        return {"total": self.analysed + self.skipped, "analysed": self.analysed, "skipped": self.skipped}
+
 def get_OD_report(student_email: str, student_test: str, student_report: dict):
     logger.log(f"Running object detection for student: {student_email} for test: {student_test}")
     try:
-        # Query the "periodicPhotos" collection and retrieve all images for the student's email and test
-        periodic_photos_data = db.get_mongo_collection("periodicPhotos", {"student": student_email, "exam": student_test})
-        if not periodic_photos_data:
+        photos_query = {"student": student_email, "exam": student_test}
+        if not db.exists("periodicPhotos", photos_query):
             student_report["objectDetection"] = "FAIL: No periodic photos found."
             return
 
+        image_processor = Models.image_processor
+        # Photos are decoded straight to (about) the detector's input size
+        draft_size = image_utils.model_input_size(image_processor)
+        # Photos already seen by this model are served from the inference cache, only new ones are decoded
+        model_key = cache_model_key("object_detection_model", OD_THRESHOLD, draft_size)
+
+        sampler = FrameSampler()
+
+        def sampled(batches):
+            # Drop the photos that barely changed since the last analysed one, and regroup the others
+            # in OD_BATCH_SIZE batches so the detector still gets full batches
+            kept = []
+            for photos in batches:
+                if sampler.enabled:
+                    signatures = pool.map(image_utils.frame_signature, [photo_data["image"] for photo_data in photos])
+                    photos = [photo_data for photo_data, signature in zip(photos, signatures) if sampler.keep(signature)]
+                else:
+                    sampler.analysed += len(photos)
+                kept.extend(photos)
+                while len(kept) >= OD_BATCH_SIZE:
+                    yield kept[:OD_BATCH_SIZE]
+                    kept = kept[OD_BATCH_SIZE:]
+            if kept:
+                yield kept
+
+        def with_cached_detections(batches):
+            # Attach the content hashes and cached detections to every batch of photos
+            for photos in batches:
+                content_hashes = [inference_cache.content_hash(photo_data["image"]) for photo_data in photos]
+                yield photos, content_hashes, inference_cache.get_many(model_key, content_hashes)
+
+        def missing_images(batch):
+            photos, content_hashes, detections_by_hash = batch
+            return [photo_data["image"] for photo_data, content_hash in zip(photos, content_hashes)
+                    if content_hash not in detections_by_hash]
+
         object_detected = False  # Flag to track if any object is detected
+        detected_buffer = []  # Detections waiting to be written
+
+        # Stream the student's "periodicPhotos" OD_BATCH_SIZE at a time, so only a bounded window
+        # of photos and decoded images is in memory
+        batches = db.find_batches("periodicPhotos", photos_query,
+                                  sort=db.TIME_ORDER, batch_size=OD_BATCH_SIZE)
+        with ThreadPoolExecutor(max_workers=OD_DECODE_WORKERS) as pool:
+            for (photos, content_hashes, detections_by_hash), images in image_utils.decode_ahead(
+                    with_cached_detections(sampled(batches)), missing_images, pool, draft_size):
+                # Run the new images of the batch through the Object Detection model at once
+                if images:
+                    missing_hashes = [content_hash for content_hash in content_hashes if content_hash not in detections_by_hash]
+                    detections = detect_objects(images, image_processor, Models.object_detection_model)
+                    batch_detections = dict(zip(missing_hashes, detections))
+                    inference_cache.put_many(model_key, batch_detections)
+                    detections_by_hash.update(batch_detections)
+
+                for photo_data, content_hash in zip(photos, content_hashes):
+                    image_detections = detections_by_hash[content_hash]
+                    logger.log(f"Detected objects at {photo_data['time']}: {image_detections}", logging.DEBUG)
+                    cell_phone_confidence = max((score for label, score in image_detections if label == "cell phone"), default=0)
+
+                    # If an object is detected, store the photo data in ObjectDetectionData collection
+                    if cell_phone_confidence > CELL_PHONE_CONFIDENCE:
+                        object_detected = True
+                        detected_data = {
+                            "student": photo_data["student"],
+                            "exam": photo_data["exam"],
+                            "time": photo_data["time"],
+                            "image": photo_data["image"]
+                        }
+                        detected_buffer.append(detected_data)
+                        if len(detected_buffer) >= OD_WRITE_BATCH_SIZE:
+                            db.insert_many_into_mongo_collection("ObjectDetectionData", detected_buffer)
+                            detected_buffer = []
 
-        for photo_data in periodic_photos_data:
-            # Convert base64 to Image
-            base64_image = photo_data["image"]
-            image_data = base64.b64decode(base64_image.split(',')[1])
-            image = Image.open(BytesIO(image_data))
-            image = image.convert('RGB')
-            # Run the images through the Object Detection model
-            inputs = Models.image_processor(images=image, return_tensors="pt")
-            outputs = Models.object_detection_model(**inputs)
-            # Convert outputs to COCO API
-            target_sizes = torch.tensor([image.size[::-1]])
-            results = Models.image_processor.post_process_object_detection(outputs, threshold=0.5, target_sizes=target_sizes)[0]
-
-            person_detected = False
-            cell_phone_detected = False
-            cell_phone_confidence = 0
-
-            for score, label in zip(results["scores"], results["labels"]):
-                detected_object = Models.object_detection_model.config.id2label[label.item()]
-                print('detected_object:', detected_object)
-                if detected_object == "person":
-                    person_detected = True
-                elif detected_object == "cell phone":
-                    cell_phone_detected = True
-                    cell_phone_confidence = score.item()
-
-            # If an object is detected, store the photo data in ObjectDetectionData collection
-            if cell_phone_detected and cell_phone_confidence > 0.9:
-                object_detected = True
-                detected_data = {
-                    "student": photo_data["student"],
-                    "exam": photo_data["exam"],
-                    "time": photo_data["time"],
-                    "image": photo_data["image"]
-                }
-                db.insert_into_mongo_collection("ObjectDetectionData", detected_data)
+        db.insert_many_into_mongo_collection("ObjectDetectionData", detected_buffer)
 
         # Set the report status based on whether any object was detected
         student_report["objectDetection"] = "FAIL" if object_detected else "SUCCESS"
+        # How many photos change detection let through to the detector
+        student_report["objectDetectionFrames"] = sampler.stats()
+        logger.log(f"Object detection analysed {sampler.analysed} of {sampler.analysed + sampler.skipped} photos", logging.DEBUG)
                 
     except ErrorHandler.Error as e:
         ErrorHandler.handle_exception(e)
         logger.log(str(e), logging.ERROR)
 
 
-def get_speech_report(student_email: str, student_test: str, student_report: dict):
+class ThemeClassifier:
+    """Zero-shot classification of many texts against one exam's theme list.
+    Uses the NLI model and tokenizer of the zero-shot pipeline directly: the theme hypotheses are
+    tokenized once, and every (text, theme) pair of a batch goes through the model in one forward pass.
+    Scores match the pipeline's: a softmax of the entailment logits over the themes, or with a single theme
+    (which the pipeline treats as multi-label) a softmax of its entailment against its contradiction logit."""
+
+    def __init__(self, classifier, themes: tuple):
+        if not themes:
+            raise ValueError("You must include at least one theme")
+        self.model = classifier.model
+        self.tokenizer = classifier.tokenizer
+        self.themes = list(themes)
+        self.entailment_id = classifier.entailment_id
+        self.max_length = min(self.tokenizer.model_max_length, SPEECH_MAX_LENGTH)
+        self.hypotheses = [self.tokenizer.encode(SPEECH_HYPOTHESIS_TEMPLATE.format(theme), add_special_tokens=False)
+                           for theme in self.themes]
+        # Room left for the text once the longest hypothesis and the special tokens are in
+        special_tokens = self.tokenizer.num_special_tokens_to_add(pair=True)
+        self.max_text_length = self.max_length - max(map(len, self.hypotheses)) - special_tokens
+        if self.max_text_length <= 0:
+            raise ValueError("Themes are too long for the speech classifier")
+
+    def chunk(self, text: str):
+        # Split a text into pieces that fit the model, instead of letting the tokenizer truncate it
+        token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+        return [self.tokenizer.decode(token_ids[start:start + self.max_text_length])
+                for start in range(0, len(token_ids), self.max_text_length)] or [text]
+
+    def classify(self, texts: list):
+        # Return, per text, {"labels", "scores"} sorted by decreasing score like the pipeline does
+        if not texts:
+            return []
+        texts_ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        pairs = [
+            self.tokenizer.prepare_for_model(text_ids, hypothesis, truncation="only_first", max_length=self.max_length)
+            for text_ids in texts_ids for hypothesis in self.hypotheses
+        ]
+        inputs = self.tokenizer.pad(pairs, return_tensors="pt")
+        record_inference("speech_classifier", len(texts))
+        with metrics.timer("model_inference_duration_seconds", model="speech_classifier"), torch.inference_mode():
+            logits = self.model(**inputs.to(self.model.device)).logits
+        if len(self.hypotheses) == 1:
+            contradiction_id = -1 if self.entailment_id == 0 else 0
+            theme_scores = logits[:, [contradiction_id, self.entailment_id]].softmax(dim=-1)[:, 1:]
+        else:
+            theme_scores = logits[:, self.entailment_id].reshape(len(texts), len(self.hypotheses)).softmax(dim=-1)
+        results = []
+        for scores in theme_scores.tolist():
+            ranked = sorted(zip(self.themes, scores), key=lambda pair: pair[1], reverse=True)
+            results.append({"labels": [label for label, _ in ranked], "scores": [score for _, score in ranked]})
+        return results
+
+@lru_cache(maxsize=32)
+def get_theme_classifier(classifier, themes: tuple):
+    # One ThemeClassifier (and one set of hypothesis encodings) per loaded classifier and theme list
+    return ThemeClassifier(classifier, themes)
+
+# The cached ThemeClassifiers refer to the model, which could not be reclaimed once unloaded
+Models.on_unload(lambda name: get_theme_classifier.cache_clear() if name == "speech_classifier" else None)
+
+def classify_texts(theme_classifier: ThemeClassifier, texts: list):
+    # Zero-shot classification of texts, served from the inference cache when possible. Only misses reach the model
+    model_key = cache_model_key("speech_classifier")
+    content_hashes = [inference_cache.content_hash(text, *theme_classifier.themes) for text in texts]
+    results = inference_cache.get_many(model_key, content_hashes)
+    missing = {content_hash: text for content_hash, text in zip(content_hashes, texts) if content_hash not in results}
+    if missing:
+        new_results = dict(zip(missing, theme_classifier.classify(list(missing.values()))))
+        inference_cache.put_many(model_key, new_results)
+        results.update(new_results)
+    return [results[content_hash] for content_hash in content_hashes]
+
+def detected_theme(results: list):
+    # First (label, score) over the threshold, in text order
+    for result in results:
+        for label, score in zip(result["labels"], result["scores"]):
+            if score > SPEECH_THRESHOLD:
+                return label, score
+    return None
+
+def get_speech_report(student_email: str, student_test: str, student_report: dict, present: bool = None):
     logger.log(f"Running speech recognition for student: {student_email} for test: {student_test}")
     try:
-        # Initialize the zero-shot-classification pipeline with the specified model
-        classifier = Models.speech_classifier        
+        # Known to have no conversations, no need to query them
+        if present is False:
+            student_report["speech"] = "SUCCESS: No conversations found."
+            return
         # Query the 'conversations' collection for the specified student and test
         conversations_data = db.get_mongo_collection("conversations", {"student": student_email, "exam": student_test})     
         # If no conversations are found, we can append SUCCESS and return early
@@ -145,23 +550,26 @@ def get_speech_report(student_email: str, student_test: str, student_report: dic
         # Query the 'test' collection to get the themes for the specified student and test
         test_data = db.get_mongo_collection("test", {"student": student_email, "exam": student_test})
         # Extract the themes and split them into a list of labels
-        themes = test_data[0].get("themes", "").split(',') if test_data else []
-        # Initialize a variable to hold the merged transcript
-        merged_transcript = ""        
-        # Process each conversation snippet individually
-        for conversation in conversations_data:
-            snippet = conversation.get("conversation", "")
-            merged_transcript += snippet + " "  # Append the snippet to the merged transcript            
-            # Classify the snippet and check the probabilities
-            result = classifier(snippet, themes)
-            for label, score in zip(result["labels"], result["scores"]):
-                if score > 0.5:
-                    student_report["speech"] = f"FAIL: Detected theme '{label}' in conversation snippet with probability {score}."
-                    return  # Return early as we have detected a theme        
-        # Process the merged transcript
-        result = classifier(merged_transcript, themes)
-        for label, score in zip(result["labels"], result["scores"]):
-            if score > 0.5:
+        themes = [theme for theme in test_data[0].get("themes", "").split(',') if theme.strip()] if test_data else []
+        if not themes:
+            student_report["speech"] = "SUCCESS: No themes set for the test."
+            return
+        # The zero-shot classifier with the hypotheses of this theme list already encoded
+        classifier = get_theme_classifier(Models.speech_classifier, tuple(themes))
+        snippets = [conversation.get("conversation", "") for conversation in conversations_data]
+        # Classify the snippets SPEECH_BATCH_SIZE at a time, stopping at the first batch with a theme
+        for start in range(0, len(snippets), SPEECH_BATCH_SIZE):
+            detected = detected_theme(classify_texts(classifier, snippets[start:start + SPEECH_BATCH_SIZE]))
+            if detected:
+                label, score = detected
+                student_report["speech"] = f"FAIL: Detected theme '{label}' in conversation snippet with probability {score}."
+                return  # Return early as we have detected a theme        
+        # Process the merged transcript, in chunks that fit the model, SPEECH_BATCH_SIZE chunks at a time
+        chunks = classifier.chunk(" ".join(snippets))
+        for start in range(0, len(chunks), SPEECH_BATCH_SIZE):
+            detected = detected_theme(classify_texts(classifier, chunks[start:start + SPEECH_BATCH_SIZE]))
+            if detected:
+                label, score = detected
                 student_report["speech"] = f"FAIL: Detected theme '{label}' in merged transcript with probability {score}."
                 return  # Return early as we have detected a theme        
         # If no themes are detected in both cases, append SUCCESS to the student_report
@@ -170,4 +578,3 @@ def get_speech_report(student_email: str, student_test: str, student_report: dic
     except Exception as e:
         # Handle any exceptions that occur during the process
         student_report["speech"] = f"ERROR: An error occurred while processing speech report: {str(e)}"
-"""
\ No newline at end of file
@@ -1,6 +1,14 @@
 # LOGGING
 
 import logging
+import cProfile
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
 
 class Logger:
 
@@ -34,6 +42,151 @@ class Logger:
         else:
             self.logger.info(message)
 
+# METRICS
+
+class Metrics:
+    """In-process counters and timing histograms, rendered in the Prometheus text format by the /metrics endpoint.
+    Every metric is identified by its name and a set of labels, e.g. collection="blur"."""
+
+    # Upper bounds, in seconds, of the histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # (name, labels) -> [count per bucket, sum, count]
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe how long the block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator observing how long each call of a function (or coroutine function) takes."""
+        def decorator(func):
+            if iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _labels(labels: tuple, **extra):
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, [list(buckets), total, count]) for key, (buckets, total, count) in self._histograms.items())
+        lines = []
+        described = set()
+
+        def header(name: str, metric_type: str):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, "histogram")
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels, le=f'{bound:g}')} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=os.getenv("METRICS_ENABLED", "true").lower() == "true")
+metrics.describe("http_request_duration_seconds", "Time spent handling a request, per route")
+metrics.describe("mongo_query_duration_seconds", "Time spent in a Mongo operation, per collection")
+metrics.describe("mongo_documents_returned_total", "Documents read from Mongo, per collection")
+metrics.describe("mongo_bytes_returned_total", "BSON bytes read from Mongo, per collection")
+metrics.describe("response_cache_requests_total", "Requests to cached routes, by result (hit or miss)")
+metrics.describe("report_check_duration_seconds", "Time spent running one check of a student report, including queueing")
+metrics.describe("report_exam_duration_seconds", "Time spent producing the report of an exam")
+metrics.describe("model_inference_duration_seconds", "Time spent in a model forward pass, per model")
+metrics.describe("model_inference_batches_total", "Batches run through a model")
+metrics.describe("model_inference_items_total", "Items run through a model. Divided by the batches, the mean batch size")
+
+
+class Profiler:
+    """cProfile around a block, with the stats dumped to PROFILE_DIR (open them with pstats or snakeviz).
+    cProfile only sees the thread it runs in, and only one block is profiled at a time: a block entered
+    while another is being profiled runs unprofiled and gets no path."""
+
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+    _lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = None
+        self._profile = None
+
+    def __enter__(self):
+        if Profiler._lock.acquire(blocking=False):
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profile is None:
+            return False
+        try:
+            self._profile.disable()
+            os.makedirs(self.PROFILE_DIR, exist_ok=True)
+            safe_name = "".join(char if char.isalnum() else "_" for char in self.name).strip("_")
+            self.path = os.path.join(self.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_name}.prof")
+            self._profile.dump_stats(self.path)
+        finally:
+            Profiler._lock.release()
+        return False
+
 # ERRORS 
 
 class ErrorHandler:
@@ -54,6 +207,10 @@ class ErrorHandler:
         """Raised when there's an issue with the machine learning model."""
         pass
 
+    class QueryPlanError(Error):
+        """Raised when a query is not backed by an index and falls back to a collection scan."""
+        pass
+
     @staticmethod
     def handle_exception(e: Exception):
         """A generic method to handle exceptions based on their type."""
@@ -64,6 +221,8 @@ class ErrorHandler:
                 ErrorHandler._handle_invalid_collection_error()
             case ErrorHandler.ModelError():
                 ErrorHandler._handle_model_error()
+            case ErrorHandler.QueryPlanError():
+                ErrorHandler._handle_query_plan_error()
             case _:
                 ErrorHandler._handle_generic_error()
 
@@ -82,6 +241,11 @@ class ErrorHandler:
         print("Handling a model error.")
         # Additional handling code here
 
+    @staticmethod
+    def _handle_query_plan_error():
+        print("Handling a query plan error.")
+        # Additional handling code here
+
     @staticmethod
     def _handle_generic_error():
         print("Handling a generic exception.")
@@ -0,0 +1,96 @@
+# Module for the report task queue
+# The ML checks can be run by report workers (python -m worker) on other nodes. Every (exam, student, check)
+# is a document of the reportTasks collection. A worker leases one atomically with find_one_and_update,
+# extends the lease with heartbeats while it works and writes the result back. A task whose lease expires,
+# because its worker died, is leased again by another worker, up to TASK_MAX_ATTEMPTS times.
+
+import os
+import logging
+from datetime import datetime, timedelta
+from uuid import uuid4
+import db
+from project_utils import Logger  # Import the Logger
+
+logger = Logger(__name__)
+
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "300"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+
+# Task statuses
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def _task_key(task: dict):
+    # Filter matching a task only while the given lease is still the current one
+    return {"exam": task["exam"], "student": task["student"], "check": task["check"], "lease_id": task["lease_id"]}
+
+
+def enqueue_tasks(tasks: list):
+    # Queue (exam, student, check) tasks. Re-queueing a task resets it, and a worker still holding
+    # an older lease on it can no longer write its result
+    now = datetime.utcnow()
+    db.insert_many_into_mongo_collection("reportTasks", [
+        {"exam": exam_name, "student": student_email, "check": check_name, "status": QUEUED, "attempts": 0,
+         "lease_id": None, "lease_expires_at": None, "worker": None, "error": None, "queued_at": now}
+        for exam_name, student_email, check_name in tasks
+    ])
+    if tasks:
+        logger.log(f"Queued {len(tasks)} report tasks", logging.INFO)
+
+
+def lease_task(worker_id: str, checks: list = None, lease_seconds: int = TASK_LEASE_SECONDS):
+    # Atomically take the oldest queued task (or one whose lease expired). Returns the task, or None
+    now = datetime.utcnow()
+    query = {
+        "$or": [{"status": QUEUED}, {"status": LEASED, "lease_expires_at": {"$lt": now}}],
+        "attempts": {"$lt": TASK_MAX_ATTEMPTS},
+    }
+    if checks:
+        query["check"] = {"$in": list(checks)}
+    return db.find_one_and_update("reportTasks", query, {
+        "$set": {"status": LEASED, "lease_id": uuid4().hex, "worker": worker_id, "leased_at": now,
+                 "lease_expires_at": now + timedelta(seconds=lease_seconds)},
+        "$inc": {"attempts": 1},
+    }, sort=[("queued_at", 1)])
+
+
+def heartbeat(task: dict, lease_seconds: int = TASK_LEASE_SECONDS):
+    # Extend the lease of a task being worked on. False means the lease was lost (expired and taken over, or re-queued)
+    lease_expires_at = datetime.utcnow() + timedelta(seconds=lease_seconds)
+    return db.update_mongo_collection("reportTasks", _task_key(task), {"$set": {"lease_expires_at": lease_expires_at}}) > 0
+
+
+def complete_task(task: dict, result: dict):
+    # Mark a task done with its result. False when the lease was lost meanwhile
+    return db.update_mongo_collection("reportTasks", _task_key(task), {"$set": {
+        "status": DONE, "result": result, "error": None, "lease_id": None, "finished_at": datetime.utcnow()
+    }}) > 0
+
+
+def fail_task(task: dict, error: str):
+    # Give the task back to the queue, or mark it failed once it used all its attempts
+    status = FAILED if task["attempts"] >= TASK_MAX_ATTEMPTS else QUEUED
+    return db.update_mongo_collection("reportTasks", _task_key(task), {"$set": {
+        "status": status, "error": error, "lease_id": None, "lease_expires_at": None, "finished_at": datetime.utcnow()
+    }}) > 0
+
+
+def expire_tasks():
+    # Tasks whose last allowed lease expired are never leased again, mark them failed. Returns those tasks
+    expired = []
+    query = {"status": LEASED, "lease_expires_at": {"$lt": datetime.utcnow()}, "attempts": {"$gte": TASK_MAX_ATTEMPTS}}
+    for task in db.get_mongo_collection("reportTasks", query, {"exam": 1, "student": 1, "check": 1, "lease_id": 1, "_id": 0}):
+        # Filtering on the lease again, in case the task was re-queued or expired by another worker meanwhile
+        if db.update_mongo_collection("reportTasks", {**_task_key(task), "status": LEASED}, {"$set": {
+            "status": FAILED, "error": "Lease expired on the last attempt", "lease_id": None, "finished_at": datetime.utcnow()
+        }}) > 0:
+            expired.append(task)
+    return expired
+
+
+def open_tasks(exam_name: str):
+    # Number of tasks of an exam still queued or being worked on
+    return db.count("reportTasks", {"exam": exam_name, "status": {"$in": [QUEUED, LEASED]}})
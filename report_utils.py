@@ -0,0 +1,485 @@
+# Module for report generation
+# Reports are produced by a scheduler: students of every exam are processed concurrently up to a limit,
+# the database-only checks run on the async_db executor and the ML checks on a dedicated, sized worker pool.
+
+import asyncio
+import os
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from uuid import uuid4
+import db
+import async_db
+import queue_utils
+import ml_utils as ML
+from cache_utils import response_cache
+from project_utils import Logger, ErrorHandler, metrics  # Import the Logger and ErrorHandler
+
+logger = Logger(__name__)
+
+# How many students are processed at the same time, across all exams
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "8"))
+# Threads running model inference. Keep it at 1 per GPU, more on multi-core CPU nodes
+REPORT_ML_WORKERS = int(os.getenv("REPORT_ML_WORKERS", "1"))
+# Where the ML checks run: "inline" in this process, or "queue" to leave them to report workers (python -m worker)
+REPORT_ML_EXECUTION = os.getenv("REPORT_ML_EXECUTION", "inline")
+
+# The checks of a student report, in the order their keys appear in the report.
+# Database checks only query Mongo. ML checks run a model
+DATABASE_CHECKS = {"outOfFrame": ML.get_OOF_report, "blur": ML.get_blur_report}
+ML_CHECKS = {"screenshot": ML.get_screenshot_report, "objectDetection": ML.get_OD_report, "speech": ML.get_speech_report}
+CHECK_ORDER = ["screenshot", "outOfFrame", "blur", "objectDetection", "speech"]
+# Checks that accept the presence flag of a collection (computed for a whole exam by db.get_presence_flags)
+PRESENCE_SOURCES = {"outOfFrame": "outOfFrame", "blur": "blur", "speech": "conversations"}
+
+# The collections each check reads. When one of them gets new documents for a student, the check is re-run
+CHECK_SOURCES = {
+    "screenshot": ["screenshot"],
+    "outOfFrame": ["outOfFrame"],
+    "blur": ["blur"],
+    "objectDetection": ["periodicPhotos"],
+    "speech": ["conversations", "test"],
+}
+SOURCE_COLLECTIONS = sorted({collection for collections in CHECK_SOURCES.values() for collection in collections})
+# Report values starting with these prefixes count as a failed check, e.g. "FAIL: No screenshot." or "ERROR: ..."
+FAILED_PREFIXES = ("FAIL", "ERROR")
+# Result of an ML check queued for a report worker
+PENDING_RESULT = "PENDING: Queued for a report worker."
+# Collection holding the per-exam summaries of each report collection
+SUMMARY_COLLECTIONS = {"reports": "reportSummaries", "reportsStaging": "reportSummariesStaging"}
+# ObjectIds are generated by the clients, whose clocks may drift. The tailer re-reads this much history
+WATERMARK_LAG_SECONDS = int(os.getenv("WATERMARK_LAG_SECONDS", "300"))
+
+
+def retrieve_students(exam_name: str):
+    try:
+        logger.log(f"Fetching the list of students for the test: {exam_name}", logging.INFO)
+        # Exam names are matched case-insensitively, as the front-end does not normalise them
+        exam_query = {"exam": {"$regex": f"^{re.escape(exam_name)}$", "$options": "i"}}
+        students_list = db.get_distinct_values("test", "student", exam_query)
+        logger.log(f"Students list: {students_list}", logging.INFO)
+        return students_list
+    except Exception as e:
+        ErrorHandler.handle_exception(e)
+        logger.log(str(e), logging.ERROR)
+        return []
+
+
+def check_outcome(result):
+    # "failed", "passed", or None for a result that is neither (e.g. pending)
+    result = str(result)
+    if result.startswith(FAILED_PREFIXES):
+        return "failed"
+    if result.startswith("SUCCESS"):
+        return "passed"
+    return None
+
+
+def report_document(test_name: str, student_report: dict):
+    # Stored form of a student report: one document per (test, student), with the checks it failed and passed
+    outcomes = {check_name: check_outcome(student_report[check_name]) for check_name in CHECK_ORDER if check_name in student_report}
+    return {
+        "test": test_name,
+        **student_report,
+        "failed": [check_name for check_name, outcome in outcomes.items() if outcome == "failed"],
+        "passed": [check_name for check_name, outcome in outcomes.items() if outcome == "passed"],
+    }
+
+
+def save_check_result(test_name: str, student_email: str, check_name: str, check_report: dict):
+    # Write the result of one check into a student's report document, in a single atomic update,
+    # so results of other checks written at the same time by other workers are kept
+    outcome = check_outcome(check_report.get(check_name))
+    update = {"$set": check_report, "$pull": {}}
+    for field in ("failed", "passed"):
+        if field == outcome:
+            update["$addToSet"] = {field: check_name}
+        else:
+            update["$pull"][field] = check_name
+    query = {"test": test_name, "student": student_email}
+    # A student without a report yet gets one with both lists, which summarize_reports relies on.
+    # The update itself touches both lists, so it cannot create them
+    db.update_mongo_collection("reports", query, {"$setOnInsert": {"failed": [], "passed": []}}, upsert=True)
+    db.update_mongo_collection("reports", query, update)
+
+
+def pending_tasks(test_name: str, student_reports: list):
+    # (exam, student, check) of every check left pending in the given reports
+    return [(test_name, student_report["student"], check_name)
+            for student_report in student_reports
+            for check_name in CHECK_ORDER if student_report.get(check_name) == PENDING_RESULT]
+
+
+def summarize_reports(test_name: str, collection_name: str = "reports"):
+    # Count the students passing and failing each check of an exam and store it as the exam's summary
+    counts = {}
+    for check_name in CHECK_ORDER:
+        counts[f"{check_name}_failed"] = {"$sum": {"$cond": [{"$in": [check_name, "$failed"]}, 1, 0]}}
+        counts[f"{check_name}_passed"] = {"$sum": {"$cond": [{"$in": [check_name, "$passed"]}, 1, 0]}}
+    totals = db.aggregate_mongo_collection(collection_name, [
+        {"$match": {"test": test_name}},
+        {"$group": {
+            "_id": None,
+            "students": {"$sum": 1},
+            "studentsFailed": {"$sum": {"$cond": [{"$gt": [{"$size": "$failed"}, 0]}, 1, 0]}},
+            **counts,
+        }},
+    ])
+    totals = totals[0] if totals else {}
+    summary = {
+        "test": test_name,
+        "students": totals.get("students", 0),
+        "studentsFailed": totals.get("studentsFailed", 0),
+        "checks": {
+            check_name: {"passed": totals.get(f"{check_name}_passed", 0), "failed": totals.get(f"{check_name}_failed", 0)}
+            for check_name in CHECK_ORDER
+        },
+        "updated_at": datetime.utcnow().isoformat(),
+    }
+    db.insert_into_mongo_collection(SUMMARY_COLLECTIONS[collection_name], summary)
+    return summary
+
+
+def migrate_legacy_reports():
+    # Reports used to be stored as a single {"test", "reports": [...]} document per exam.
+    # Split every such document into per-student documents and a summary. Returns the migrated exams
+    migrated = []
+    for (legacy_report,) in db.find_batches("reports", {"reports": {"$exists": True}}, {"test": 1, "reports": 1}, batch_size=1):
+        test_name = legacy_report["test"]
+        db.insert_many_into_mongo_collection("reports", [report_document(test_name, student_report)
+                                                         for student_report in legacy_report["reports"]])
+        db.delete_from_mongo_collection("reports", {"test": test_name, "reports": {"$exists": True}})
+        summarize_reports(test_name)
+        response_cache.invalidate(test_name)
+        migrated.append(test_name)
+    return migrated
+
+
+def _object_id(value: dict):
+    # db returns ObjectIds in their extended JSON form
+    return ObjectId(value["$oid"])
+
+def _latest_ids(collection_name: str, match: dict):
+    # Newest _id per (exam, student) among the documents of collection_name matching match
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": {"exam": "$exam", "student": "$student"}, "last_id": {"$max": "$_id"}}}
+    ]
+    return {
+        (group["_id"].get("exam"), group["_id"].get("student")): _object_id(group["last_id"])
+        for group in db.aggregate_mongo_collection(collection_name, pipeline)
+    }
+
+def exam_watermarks(exam_name: str):
+    # The high-water marks of every student of an exam: {(exam, student): {collection: newest _id}}
+    watermarks = defaultdict(dict)
+    for collection_name in SOURCE_COLLECTIONS:
+        for key, last_id in _latest_ids(collection_name, {"exam": exam_name}).items():
+            watermarks[key][collection_name] = last_id
+    return watermarks
+
+def save_watermarks(watermarks: dict):
+    # Store {(exam, student): {collection: newest _id}} in the reportWatermarks collection
+    for (exam_name, student_email), last_ids in watermarks.items():
+        for collection_name, last_id in last_ids.items():
+            db.update_mongo_collection(
+                "reportWatermarks",
+                {"exam": exam_name, "student": student_email, "collection": collection_name},
+                {"$max": {"last_id": last_id}},
+                upsert=True
+            )
+
+def find_changed_students(exam_names: set):
+    # Polling tailer. Returns (changed, scanned): {(exam, student): {collection: newest _id}} for the students of
+    # exam_names with documents newer than their stored watermark, in any of the SOURCE_COLLECTIONS, and
+    # {collection: newest _id scanned}, to pass to save_scan_positions once the changes are processed
+    changed = defaultdict(dict)
+    scanned = {}
+    positions = {
+        position["collection"]: _object_id(position["scanned_to"])
+        for position in db.get_mongo_collection("reportTailer", {}, {"collection": 1, "scanned_to": 1, "_id": 0})
+    }
+    for collection_name in SOURCE_COLLECTIONS:
+        # Only look at documents inserted after the previous scan of this collection (minus the clock lag).
+        # The report watermarks cannot be used for this: a report of a new exam moves them past events
+        # of the other exams that no scan has seen yet
+        match = {"exam": {"$in": list(exam_names)}}
+        if collection_name in positions:
+            since = positions[collection_name].generation_time - timedelta(seconds=WATERMARK_LAG_SECONDS)
+            match["_id"] = {"$gt": ObjectId.from_datetime(since)}
+        latest_ids = _latest_ids(collection_name, match)
+        if not latest_ids:
+            continue
+        scanned[collection_name] = max(latest_ids.values())
+        stored = {
+            (watermark["exam"], watermark["student"]): _object_id(watermark["last_id"])
+            for watermark in db.get_mongo_collection(
+                "reportWatermarks",
+                {"collection": collection_name, "exam": {"$in": list({exam for exam, _ in latest_ids})}},
+                {"exam": 1, "student": 1, "last_id": 1, "_id": 0}
+            )
+        }
+        for key, last_id in latest_ids.items():
+            if key not in stored or last_id > stored[key]:
+                changed[key][collection_name] = last_id
+    return changed, scanned
+
+def save_scan_positions(scanned: dict):
+    # Move the tailer forward to {collection: newest _id scanned}
+    for collection_name, last_id in scanned.items():
+        db.update_mongo_collection("reportTailer", {"collection": collection_name},
+                                   {"$max": {"scanned_to": last_id}}, upsert=True)
+
+
+class ReportScheduler:
+    """Runs report generation concurrently and tracks the progress of each exam."""
+
+    def __init__(self, concurrency: int = REPORT_CONCURRENCY, ml_workers: int = REPORT_ML_WORKERS):
+        self.concurrency = concurrency
+        self.ml_pool = ThreadPoolExecutor(max_workers=ml_workers, thread_name_prefix="ml")
+        self.progress = {}
+        # Watermarks and pending tasks of reports built into a staging collection,
+        # saved and queued once the staging collection is swapped in
+        self.staged_watermarks = {}
+        self.staged_tasks = []
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def run_check(self, check_name: str, student_email: str, student_test: str, presence: dict = None):
+        # Run one check into its own dict, so concurrent checks never write to the same report
+        check_report = dict()
+        options = {}
+        if presence is not None and check_name in PRESENCE_SOURCES:
+            options["present"] = presence[PRESENCE_SOURCES[check_name]]
+        if check_name in ML_CHECKS and REPORT_ML_EXECUTION == "queue":
+            # A report worker runs it and writes its result into the student's document
+            return {check_name: PENDING_RESULT}
+        with metrics.timer("report_check_duration_seconds", check=check_name):
+            if check_name in ML_CHECKS:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.ml_pool, partial(ML_CHECKS[check_name], student_email, student_test, check_report, **options))
+            else:
+                await async_db.run(DATABASE_CHECKS[check_name], student_email, student_test, check_report, **options)
+        return check_report
+
+    async def get_student_report(self, student_email: str, student_test: str, checks: list = CHECK_ORDER,
+                                 presence: dict = None):
+        # Run the given checks (all of them by default) for a student. presence holds the student's
+        # presence flags when they are already known
+        async with self.semaphore:
+            logger.log(f"Generating report for student: {student_email}", logging.INFO)
+            # Initialize an empty dictionary that will hold the report for the student
+            student_report = dict()
+            student_report["student"] = student_email
+            # All checks run at the same time, the results are merged in CHECK_ORDER
+            results = await asyncio.gather(
+                *(self.run_check(check_name, student_email, student_test, presence) for check_name in checks),
+                return_exceptions=True
+            )
+            for check_name, result in zip(checks, results):
+                if isinstance(result, Exception):
+                    ErrorHandler.handle_exception(result)
+                    logger.log(f"Error running the {check_name} check for student {student_email}: {str(result)}", logging.ERROR)
+                else:
+                    student_report.update(result)
+            logger.log(f"Report generated successfully for student: {student_email}", logging.INFO)
+            self.progress[student_test]["students_done"] += 1
+            return student_report
+
+    @metrics.timed("report_exam_duration_seconds")
+    async def produce_report(self, test_name: str, collection_name: str = "reports"):
+        # Produce full report for a given exam and store it in collection_name
+        logger.log(f"Generating reports for test: {test_name}", logging.INFO)
+        progress = self.progress[test_name] = {
+            "status": "running", "students_total": 0, "students_done": 0,
+            "started_at": datetime.utcnow().isoformat(), "finished_at": None
+        }
+        try:
+            # Step 1: Retrieve the list of students who took the test,
+            # and the newest source documents the report is built from
+            students_list = await async_db.run(retrieve_students, test_name)
+            watermarks = await async_db.run(exam_watermarks, test_name)
+            # The outOfFrame/blur/conversations presence of every student, in a single round trip
+            presence_flags = await async_db.get_presence_flags(test_name)
+            progress["students_total"] = len(students_list)
+            # Step 2: Generate the report of every student, concurrently
+            student_reports = await asyncio.gather(
+                *(self.get_student_report(student_email, test_name, presence=presence_flags.get(student_email))
+                  for student_email in students_list)
+            )
+            # Step 3: Store one document per student, and the exam's summary
+            await async_db.insert_many_into_mongo_collection(
+                collection_name, [report_document(test_name, student_report) for student_report in student_reports]
+            )
+            await async_db.run(summarize_reports, test_name, collection_name)
+            # Step 4: Remember what the report covers, for the incremental updates, and queue its pending checks.
+            # Workers write into the reports collection, so checks of a staged report wait for the swap
+            tasks = pending_tasks(test_name, student_reports)
+            if collection_name == "reports":
+                await async_db.run(save_watermarks, watermarks)
+                await async_db.run(queue_utils.enqueue_tasks, tasks)
+                await async_db.run(response_cache.invalidate, test_name)
+            else:
+                self.staged_watermarks[test_name] = watermarks
+                self.staged_tasks.extend(tasks)
+            progress["status"] = "done"
+            logger.log(f"Reports generated successfully for test: {test_name}", logging.INFO)
+        except Exception:
+            progress["status"] = "failed"
+            raise
+        finally:
+            progress["finished_at"] = datetime.utcnow().isoformat()
+
+    async def produce_reports(self, test_names, collection_name: str = "reports", on_start=None):
+        # Produce the reports of several exams concurrently. Returns the names of the exams that failed.
+        # on_start, when given, is called with the exam names before any report is produced
+        test_names = list(test_names)
+        if on_start:
+            on_start(test_names)
+        for test_name in test_names:
+            self.progress[test_name] = {"status": "pending", "students_total": 0, "students_done": 0,
+                                        "started_at": None, "finished_at": None}
+        results = await asyncio.gather(*(self.produce_report(test_name, collection_name) for test_name in test_names), return_exceptions=True)
+        failed = []
+        for test_name, result in zip(test_names, results):
+            if isinstance(result, Exception):
+                ErrorHandler.handle_exception(result)
+                logger.log(f"Error generating the report for test {test_name}: {str(result)}", logging.ERROR)
+                failed.append(test_name)
+        return failed
+
+    def clear_staged(self):
+        self.staged_watermarks.clear()
+        self.staged_tasks.clear()
+
+    async def commit_staged(self):
+        # Called once the staging collection has replaced the reports
+        staged_watermarks, self.staged_watermarks = self.staged_watermarks, {}
+        staged_tasks, self.staged_tasks = self.staged_tasks, []
+        for watermarks in staged_watermarks.values():
+            await async_db.run(save_watermarks, watermarks)
+        await async_db.run(queue_utils.enqueue_tasks, staged_tasks)
+
+    async def update_student_entry(self, test_name: str, student_email: str, collections: dict):
+        # Re-run the checks reading from the changed collections and rewrite only this student's document
+        checks = [check_name for check_name in CHECK_ORDER if set(CHECK_SOURCES[check_name]) & set(collections)]
+        existing = await async_db.get_mongo_collection("reports", {"test": test_name, "student": student_email},
+                                                       {"_id": 0, "test": 0, "failed": 0, "passed": 0}, limit=1)
+        if not existing:
+            # A student who joined after the report was built gets a full report
+            student_report = await self.get_student_report(student_email, test_name)
+        else:
+            student_report = {**existing[0], **await self.get_student_report(student_email, test_name, checks)}
+        await async_db.insert_into_mongo_collection("reports", report_document(test_name, student_report))
+        await async_db.run(save_watermarks, {(test_name, student_email): collections})
+        await async_db.run(queue_utils.enqueue_tasks, pending_tasks(test_name, [student_report]))
+
+    async def update_changed_reports(self, on_start=None):
+        # Incremental refresh of the existing reports. Returns (updated exams, exams that failed).
+        # on_start, when given, is called with the changed exams before any report is updated
+        reported_exam_names = set(await async_db.get_distinct_values("reportSummaries", "test"))
+        changed, scanned = await async_db.run(find_changed_students, reported_exam_names)
+        changed_exams = sorted({test_name for test_name, _ in changed})
+        if on_start:
+            on_start(changed_exams)
+        for test_name in changed_exams:
+            self.progress[test_name] = {
+                "status": "running", "students_total": sum(1 for exam, _ in changed if exam == test_name),
+                "students_done": 0, "started_at": datetime.utcnow().isoformat(), "finished_at": None
+            }
+        results = await asyncio.gather(
+            *(self.update_student_entry(test_name, student_email, collections)
+              for (test_name, student_email), collections in changed.items()),
+            return_exceptions=True
+        )
+        failed = set()
+        for (test_name, student_email), result in zip(changed, results):
+            if isinstance(result, Exception):
+                ErrorHandler.handle_exception(result)
+                logger.log(f"Error updating the report of {student_email} for test {test_name}: {str(result)}", logging.ERROR)
+                failed.add(test_name)
+        for test_name in changed_exams:
+            await async_db.run(summarize_reports, test_name)
+            await async_db.run(response_cache.invalidate, test_name)
+            self.progress[test_name]["status"] = "failed" if test_name in failed else "done"
+            self.progress[test_name]["finished_at"] = datetime.utcnow().isoformat()
+        # When a student could not be updated, the next poll scans the same events again
+        if not failed:
+            await async_db.run(save_scan_positions, scanned)
+        return changed_exams, sorted(failed)
+
+
+class RefreshJobs:
+    """In-process registry of report refresh jobs.
+    A job that is already queued or running is returned instead of starting a duplicate,
+    and jobs run one at a time so a full refresh never races a partial one."""
+
+    # Finished jobs kept around for the status endpoint
+    MAX_FINISHED_JOBS = 100
+
+    def __init__(self):
+        self.jobs = {}
+        self._lock = None
+
+    @property
+    def lock(self):
+        # Created on first use so it belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def submit(self, kind: str):
+        # Return (job, created). created is False when an identical job is already pending
+        for job in self.jobs.values():
+            if job["kind"] == kind and job["status"] in ("queued", "running"):
+                return job, False
+        self._forget_finished_jobs()
+        job = {
+            "job_id": uuid4().hex, "kind": kind, "status": "queued",
+            "submitted_at": datetime.utcnow().isoformat(), "started_at": None, "finished_at": None,
+            "exams": [], "failed": [], "error": None
+        }
+        self.jobs[job["job_id"]] = job
+        return job, True
+
+    async def run(self, job_id: str, refresh):
+        # Run refresh(on_start), a coroutine function returning (exam names, failed exam names), as the given job.
+        # The refresh calls on_start with its exams once it knows them, so their progress shows while it runs
+        job = self.jobs[job_id]
+
+        def on_start(exams):
+            job["exams"] = list(exams)
+
+        async with self.lock:
+            job["status"] = "running"
+            job["started_at"] = datetime.utcnow().isoformat()
+            try:
+                exams, failed = await refresh(on_start)
+                job["exams"], job["failed"] = list(exams), list(failed)
+                job["status"] = "failed" if failed else "done"
+            except Exception as e:
+                ErrorHandler.handle_exception(e)
+                logger.log(f"Error running {job['kind']} refresh job {job_id}: {str(e)}", logging.ERROR)
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                job["finished_at"] = datetime.utcnow().isoformat()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+
+report_scheduler = ReportScheduler()
+refresh_jobs = RefreshJobs()
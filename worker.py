@@ -0,0 +1,172 @@
+# Report worker
+# Runs the ML checks of the reports on this node, e.g. a GPU machine, for an API started with
+# REPORT_ML_EXECUTION=queue. Tasks are leased from the reportTasks queue (see queue_utils.py), so any number
+# of workers on any number of nodes can share the work. A worker that dies loses its lease, and the task
+# is leased again by another worker once the lease expires. Set the API's RESPONSE_CACHE_REDIS_URL here too,
+# so the results written by the worker invalidate the API's cached responses.
+#
+# python -m worker [--checks speech objectDetection] [--warm-up] [--max-tasks N]
+# python -m worker --enqueue EXAM [EXAM ...]    (queue every ML check of every student of the exams, and exit)
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import traceback
+import db
+import queue_utils
+import report_utils
+import ml_utils as ML
+from cache_utils import response_cache
+from project_utils import Logger, ErrorHandler  # Import the Logger and ErrorHandler
+
+logger = Logger(__name__)
+
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+# Longest wait between retries after an error, e.g. while the database is unreachable
+WORKER_MAX_BACKOFF_SECONDS = float(os.getenv("WORKER_MAX_BACKOFF_SECONDS", "60"))
+
+
+def invalidate_responses(exam_name: str):
+    # Only a shared (Redis) response cache is the API's, see main.check_response_cache
+    if response_cache.store.remote:
+        response_cache.invalidate(exam_name)
+
+
+class Worker:
+    """Leases report tasks one at a time, runs their check and writes the result into the student's report."""
+
+    def __init__(self, checks: list = None, lease_seconds: int = queue_utils.TASK_LEASE_SECONDS,
+                 poll_seconds: float = WORKER_POLL_SECONDS):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.checks = list(checks or report_utils.ML_CHECKS)
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.stopping = threading.Event()
+
+    def stop(self, *_):
+        # The task being run is finished first
+        logger.log(f"Worker {self.worker_id} stopping", logging.INFO)
+        self.stopping.set()
+
+    def run(self, max_tasks: int = None):
+        # Work until stopped, or until max_tasks tasks were run. Returns how many were run
+        logger.log(f"Worker {self.worker_id} running the checks: {', '.join(self.checks)}", logging.INFO)
+        done = 0
+        backoff = 0
+        while not self.stopping.is_set() and (max_tasks is None or done < max_tasks):
+            try:
+                task = queue_utils.lease_task(self.worker_id, self.checks, self.lease_seconds)
+                if task is None:
+                    self.expire_tasks()
+                    self.stopping.wait(self.poll_seconds)
+                    continue
+                done += 1
+                self.run_task(task)
+                backoff = 0
+            except Exception as e:
+                # Keep the worker alive through transient errors. A task it held is leased again once its lease expires
+                backoff = min(max(2 * backoff, 1), WORKER_MAX_BACKOFF_SECONDS)
+                ErrorHandler.handle_exception(e)
+                logger.log(f"Worker {self.worker_id} error, retrying in {backoff:.0f}s: {str(e)}", logging.ERROR)
+                self.stopping.wait(backoff)
+        return done
+
+    def expire_tasks(self):
+        # Tasks out of attempts because their last worker stopped responding show an error in their report
+        expired = queue_utils.expire_tasks()
+        for task in expired:
+            report_utils.save_check_result(task["exam"], task["student"], task["check"], {
+                task["check"]: f"ERROR: No report worker finished the check in {queue_utils.TASK_MAX_ATTEMPTS} attempts."
+            })
+        for exam_name in sorted({task["exam"] for task in expired}):
+            invalidate_responses(exam_name)
+            self.summarize_if_done(exam_name)
+
+    def run_task(self, task: dict):
+        exam_name, student_email, check_name = task["exam"], task["student"], task["check"]
+        logger.log(f"Running the {check_name} check of {student_email} for test {exam_name} (attempt {task['attempts']})", logging.INFO)
+        # Step 1: Keep the lease alive while the check runs
+        finished = threading.Event()
+        lease_lost = threading.Event()
+
+        def keep_lease():
+            while not finished.wait(self.lease_seconds / 3):
+                if not queue_utils.heartbeat(task, self.lease_seconds):
+                    lease_lost.set()
+                    return
+
+        heartbeats = threading.Thread(target=keep_lease, name="lease-heartbeat", daemon=True)
+        heartbeats.start()
+        # Step 2: Run the check into its own dict
+        check_report = dict()
+        try:
+            report_utils.ML_CHECKS[check_name](student_email, exam_name, check_report)
+        except Exception as e:
+            ErrorHandler.handle_exception(e)
+            logger.log(f"Error running the {check_name} check of {student_email}: {str(e)}", logging.ERROR)
+            if queue_utils.fail_task(task, traceback.format_exc(limit=5)) and task["attempts"] >= queue_utils.TASK_MAX_ATTEMPTS:
+                # No attempts left, the report shows the error instead of staying pending
+                report_utils.save_check_result(exam_name, student_email, check_name, {check_name: f"ERROR: {str(e)}"})
+                self.summarize_if_done(exam_name)
+            return
+        finally:
+            finished.set()
+            heartbeats.join()
+        # Step 3: Write the result, unless another worker took the task over meanwhile
+        if lease_lost.is_set() or not queue_utils.heartbeat(task, self.lease_seconds):
+            logger.log(f"Lease lost on the {check_name} check of {student_email}, dropping its result", logging.WARNING)
+            return
+        report_utils.save_check_result(exam_name, student_email, check_name, check_report)
+        queue_utils.complete_task(task, check_report)
+        invalidate_responses(exam_name)
+        # Step 4: The last task of an exam refreshes its summary
+        self.summarize_if_done(exam_name)
+
+    def summarize_if_done(self, exam_name: str):
+        if queue_utils.open_tasks(exam_name) == 0:
+            report_utils.summarize_reports(exam_name)
+            invalidate_responses(exam_name)
+            logger.log(f"All queued checks done for test: {exam_name}", logging.INFO)
+
+
+def enqueue_exams(exam_names: list, checks: list):
+    # Queue the given checks of every student of the exams
+    tasks = [(exam_name, student_email, check_name)
+             for exam_name in exam_names
+             for student_email in report_utils.retrieve_students(exam_name)
+             for check_name in checks]
+    queue_utils.enqueue_tasks(tasks)
+    return len(tasks)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Run the ML checks of queued report tasks")
+    arg_parser.add_argument("--checks", nargs="+", choices=sorted(report_utils.ML_CHECKS), default=None,
+                            help="checks this worker runs (all ML checks by default)")
+    arg_parser.add_argument("--lease-seconds", type=int, default=queue_utils.TASK_LEASE_SECONDS)
+    arg_parser.add_argument("--poll-seconds", type=float, default=WORKER_POLL_SECONDS)
+    arg_parser.add_argument("--warm-up", action="store_true", help="load the models before leasing tasks")
+    arg_parser.add_argument("--max-tasks", type=int, default=None, help="exit after this many tasks")
+    arg_parser.add_argument("--enqueue", nargs="+", metavar="EXAM", help="queue the checks of these exams and exit")
+    args = arg_parser.parse_args()
+    checks = args.checks or sorted(report_utils.ML_CHECKS)
+
+    db.ensure_indexes()
+    if args.enqueue:
+        print(f"Queued {enqueue_exams(args.enqueue, checks)} tasks")
+        return
+    if not response_cache.store.remote:
+        logger.log("RESPONSE_CACHE_REDIS_URL is not set, the API must run without a response cache to show the results", logging.WARNING)
+    if args.warm_up:
+        ML.Models.warm_up(background=False)
+    worker = Worker(checks, args.lease_seconds, args.poll_seconds)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run(args.max_tasks)
+
+
+if __name__ == "__main__":
+    main()